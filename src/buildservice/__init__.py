@@ -8,6 +8,7 @@ import os
 import pakfire
 
 from . import arches
+from . import base
 from . import bugtracker
 from . import builders
 from . import builds
@@ -15,17 +16,21 @@ from . import cache
 from . import database
 from . import distribution
 from . import geoip
+from . import indexer
 from . import jobqueue
 from . import jobs
 from . import keys
 from . import logs
 from . import messages
 from . import mirrors
+from . import misc
 from . import packages
 from . import repository
+from . import scheduler
 from . import settings
 from . import sessions
 from . import sources
+from . import storage
 from . import updates
 from . import uploads
 from . import users
@@ -44,15 +49,21 @@ class Backend(object):
 
 	def __init__(self, config_file=None):
 		# Read configuration file.
+		self.config_file = config_file
 		self.config = self.read_config(config_file)
 
 		# Global pakfire settings (from database).
 		self.settings = settings.Settings(self)
 
+		# Shares objects that have been loaded from the database
+		self.objects     = base.IdentityMap()
+
 		self.arches      = arches.Arches(self)
 		self.builds      = builds.Builds(self)
 		self.cache       = cache.Cache(self)
+		self.credentials = cache.CredentialCache()
 		self.geoip       = geoip.GeoIP(self)
+		self.indexer     = indexer.Indexer(self)
 		self.jobs        = jobs.Jobs(self)
 		self.builders    = builders.Builders(self)
 		self.distros     = distribution.Distributions(self)
@@ -62,8 +73,10 @@ class Backend(object):
 		self.mirrors     = mirrors.Mirrors(self)
 		self.packages    = packages.Packages(self)
 		self.repos       = repository.Repositories(self)
+		self.scheduler   = scheduler.Scheduler(self)
 		self.sessions    = sessions.Sessions(self)
 		self.sources     = sources.Sources(self)
+		self.storage     = storage.Storage(self)
 		self.updates     = updates.Updates(self)
 		self.uploads     = uploads.Uploads(self)
 		self.users       = users.Users(self)
@@ -126,18 +139,68 @@ class Backend(object):
 		except ConfigParser.Error as e:
 			log.error("Error parsing the config: %s" % e.message)
 
+		# Size of the connection pool
+		min_connections = self._get_config_int("database", "min_connections", 1)
+		max_connections = self._get_config_int("database", "max_connections", 4)
+
+		# Number of rows to fetch at once when streaming results
+		fetch_size = self._get_config_int("database", "fetch_size", 1000)
+
+		# Prepare statements after they have been executed this often
+		prepare_threshold = self._get_config_int("database", "prepare_threshold", 3)
+
+		# Log queries that are slower than this many milliseconds
+		slow_query_threshold = self._get_config_int("database", "slow_query_threshold", 0)
+
+		kwargs = {
+			"min_connections"      : min_connections,
+			"max_connections"      : max_connections,
+			"fetch_size"           : fetch_size,
+			"prepare_threshold"    : prepare_threshold,
+			"slow_query_threshold" : slow_query_threshold,
+		}
+
+		# Connect to the read-only replica
+		replica = None
+
+		if self.config.has_option("database", "replica_hostname"):
+			replica_hostname = self.config.get("database", "replica_hostname")
+
+			replica_name, replica_user, replica_password = name, user, password
+			if self.config.has_option("database", "replica_name"):
+				replica_name = self.config.get("database", "replica_name")
+			if self.config.has_option("database", "replica_user"):
+				replica_user = self.config.get("database", "replica_user")
+			if self.config.has_option("database", "replica_password"):
+				replica_password = self.config.get("database", "replica_password")
+
+			log.debug("Connecting to database replica %s @ %s" % (replica_name, replica_hostname))
+
+			replica = database.Connection(replica_hostname, replica_name,
+				user=replica_user, password=replica_password, **kwargs)
+
 		log.debug("Connecting to database %s @ %s" % (name, hostname))
 
-		return database.Connection(hostname, name, user=user, password=password)
+		return database.Connection(hostname, name, user=user, password=password,
+			replica=replica, **kwargs)
 
-	def delete_file(self, path, not_before=None):
-		self.db.execute("INSERT INTO queue_delete(path, not_before) \
-			VALUES(%s, %s)", path, not_before)
+	def _get_config_int(self, section, option, default=None):
+		try:
+			return self.config.getint(section, option)
+		except (ConfigParser.Error, ValueError):
+			return default
+
+	def delete_file(self, path, not_before=None, hash=None):
+		self.db.execute("INSERT INTO queue_delete(path, not_before, hash_sha512) \
+			VALUES(%s, %s, %s)", path, not_before, hash)
 
 	def cleanup_files(self):
 		query = self.db.query("SELECT * FROM queue_delete \
 			WHERE (not_before IS NULL OR not_before <= NOW())")
 
+		# Hashes of files in the storage that have lost a link
+		released = set()
+
 		for row in query:
 			if not row.path:
 				continue
@@ -148,12 +211,21 @@ class Backend(object):
 				log.warning("Cannot delete file outside of the tree")
 				continue
 
+			hash = row.hash_sha512
+
 			try:
+				# If the file has one other link, that could be the storage
+				if not hash and os.lstat(path).st_nlink == 2:
+					hash = misc.calc_hash(path, "sha512")
+
 				logging.debug("Removing %s..." % path)
 				os.unlink(path)
 			except OSError, e:
 				logging.error("Could not remove %s: %s" % (path, e))
 
+			if hash:
+				released.add(hash)
+
 			while True:			
 				path = os.path.dirname(path)
 
@@ -173,3 +245,6 @@ class Backend(object):
 					break
 
 			self.db.execute("DELETE FROM queue_delete WHERE id = %s", row.id)
+
+		# Remove any files from the storage that are not used any more
+		self.storage.cleanup(released)
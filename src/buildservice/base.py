@@ -1,5 +1,9 @@
 #!/usr/bin/python
 
+import collections
+import contextlib
+import threading
+
 from .decorators import *
 
 class Object(object):
@@ -40,17 +44,149 @@ class Object(object):
 	def settings(self):
 		return self.backend.settings
 
+	def _get_by_ids(self, func, table, ids, **kwargs):
+		"""
+			Fetches all rows of table with the given IDs in one query,
+			turns them into objects with func and returns them in the
+			same order as the IDs
+		"""
+		if not ids:
+			return []
+
+		objects = func("SELECT * FROM %s WHERE id = ANY(%%s)" % table, list(ids), **kwargs)
+		objects = dict((o.id, o) for o in objects)
+
+		return [objects[id] for id in ids if id in objects]
+
+
+def split_prefetch(prefetch):
+	"""
+		Turns a list of relations like ("pkg", "jobs", "jobs.builder")
+		into a dictionary that maps each relation to its nested relations
+	"""
+	relations = {}
+
+	for relation in prefetch or []:
+		relation, _, nested = relation.partition(".")
+
+		nested_relations = relations.setdefault(relation, [])
+		if nested:
+			nested_relations.append(nested)
+
+	return relations
+
+
+class IdentityMap(object):
+	"""
+		Holds one instance of every DataObject per (table, id) while a
+		scope (like a web request or a unit of work in a cron job) is open
+		in the current thread, so that loading the same row again costs
+		nothing.
+
+		Scopes can be nested. Each scope holds at most maxsize objects
+		and forgets the ones that have been added first.
+	"""
+	def __init__(self, maxsize=10000):
+		self.maxsize = maxsize
+
+		self._local = threading.local()
+
+	@property
+	def _stack(self):
+		try:
+			return self._local.stack
+		except AttributeError:
+			self._local.stack = []
+
+			return self._local.stack
+
+	@property
+	def _objects(self):
+		stack = self._stack
+
+		if stack:
+			return stack[-1]
+
+	def begin(self):
+		"""
+			Opens a new, empty scope in this thread and
+			drops anything that might have been left over
+		"""
+		self._local.stack = [collections.OrderedDict()]
+
+	def end(self):
+		"""
+			Forgets all objects of this thread
+		"""
+		self._local.stack = []
+
+	@contextlib.contextmanager
+	def scope(self):
+		"""
+			Opens a nested scope for a unit of work
+		"""
+		stack = self._stack
+
+		stack.append(collections.OrderedDict())
+		try:
+			yield self
+		finally:
+			stack.pop()
+
+	def get(self, cls, id):
+		"""
+			Returns the known instance of cls with the given ID or None
+		"""
+		objects = self._objects
+
+		if objects is not None:
+			obj = objects.get((cls.table, id))
+
+			if isinstance(obj, cls):
+				return obj
+
+	def add(self, obj):
+		objects = self._objects
+
+		if objects is not None and obj.id is not None:
+			objects[(obj.table, obj.id)] = obj
+
+			# Forget the oldest objects
+			while len(objects) > self.maxsize:
+				objects.popitem(last=False)
+
 
 class DataObject(Object):
 	# Table name
 	table = None
 
+	def __new__(cls, backend, id, *args, **kwargs):
+		# Return the instance that already exists for this row
+		obj = backend.objects.get(cls, id)
+		if obj is not None:
+			return obj
+
+		return Object.__new__(cls)
+
+	def __init__(self, backend, id, data=None, *args, **kwargs):
+		# Instances from the identity map have been initialised before,
+		# but take the row if it has just been loaded from the database
+		if "id" in self.__dict__:
+			if data:
+				self.data = data
+
+			return
+
+		Object.__init__(self, backend, id, data, *args, **kwargs)
+
 	def init(self, id, data=None):
 		self.id = id
 
 		if data:
 			self.data = data
 
+		self.backend.objects.add(self)
+
 	@lazy_property
 	def data(self):
 		assert self.table, "Table name is not set"
@@ -80,25 +80,25 @@ class BugzillaBug(base.Object):
 		self.call("update", ids=[self.id,], **kwargs)
 
 		# Invalidate cache
-		self.backend.cache.delete(self.cache_key)
+		self.backend.cache.delete(self._cache_key)
 
 
 class Bugzilla(base.Object):
-	def __init__(self, pakfire):
-		base.Object.__init__(self, pakfire)
-
+	@lazy_property
+	def server(self):
 		# Open the connection to the server.
-		self.server = xmlrpclib.ServerProxy(self.url, use_datetime=True)
+		return xmlrpclib.ServerProxy(self.url, use_datetime=True)
 
-		# Cache the credentials.
-		self.__credentials = {
+	@lazy_property
+	def _credentials(self):
+		return {
 			"Bugzilla_login"    : self.user,
 			"Bugzilla_password" : self.password,
 		}
 
 	def call(self, *args, **kwargs):
 		# Add authentication information.
-		kwargs.update(self.__credentials)
+		kwargs.update(self._credentials)
 
 		method = self.server
 		for arg in args:
@@ -145,7 +145,7 @@ class Bugzilla(base.Object):
 
 	@lazy_property
 	def cache_lifetime(self):
-		return self.settings.get("bugzilla_cache_lifetime", 3600)
+		return self.settings.get_int("bugzilla_cache_lifetime", 3600) or 3600
 
 	def get_bug(self, bug_id):
 		try:
@@ -156,6 +156,41 @@ class Bugzilla(base.Object):
 
 		return bug
 
+	def get_bugs(self, bug_ids):
+		"""
+			Returns all bugs with the given IDs and fetches all
+			information that is not cached in one call
+		"""
+		bugs = [BugzillaBug(self, bug_id) for bug_id in bug_ids]
+
+		# Fetch everything that is cached at once
+		cached = self.backend.cache.get_multi([b._cache_key for b in bugs])
+
+		missing = [b.id for b in bugs if not b._cache_key in cached]
+		if missing:
+			res = self.call("Bug", "get", ids=missing, permissive=True)
+
+			fetched = {}
+			for data in res["bugs"]:
+				fetched[BugzillaBug(self, data["id"])._cache_key] = data
+
+			# Put everything into the cache
+			self.backend.cache.set_multi(fetched, self.cache_lifetime)
+			cached.update(fetched)
+
+		ret = []
+		for bug in bugs:
+			data = cached.get(bug._cache_key)
+
+			# Skip bugs that do not exist
+			if data is None:
+				continue
+
+			BugzillaBug.data.prime(bug, data)
+			ret.append(bug)
+
+		return ret
+
 	def find_users(self, pattern):
 		users = self.call("User", "get", match=[pattern,])
 		if users:
@@ -180,16 +215,9 @@ class Bugzilla(base.Object):
 
 		query = self.call("Bug", "search", include_fields=["id"], **kwargs)
 
-		bugs = []
-		for bug in query["bugs"]:
-			bug = self.get_bug(bug["id"])
-
-			if not bug.is_closed == closed:
-				continue
-
-			bugs.append(bug)
+		bugs = self.get_bugs([bug["id"] for bug in query["bugs"]])
 
-		return bugs
+		return [bug for bug in bugs if bug.is_closed == closed]
 
 	def send_all(self, limit=100):
 		# Get up to ten updates.
@@ -62,6 +62,12 @@ class Builders(base.Object):
 		if None in (name, passphrase):
 			return
 
+		# Have these credentials been verified recently?
+		builder_id = self.backend.credentials.get("builder", name, passphrase)
+		if builder_id:
+			return self._get_builder("SELECT * FROM builders \
+				WHERE id = %s AND deleted IS FALSE", builder_id)
+
 		# Search for the hostname in the database.
 		builder = self._get_builder("SELECT * FROM builders \
 			WHERE name = %s AND deleted IS FALSE", name)
@@ -71,11 +77,23 @@ class Builders(base.Object):
 		if not builder or not builder.validate_passphrase(passphrase):
 			return
 
+		self.backend.credentials.set("builder", name, passphrase, builder.id)
+
 		# Otherwise we return the Builder object.
 		return builder
 
+	def get_by_ids(self, ids):
+		"""
+			Fetches all builders with the given IDs in one query
+		"""
+		return self._get_by_ids(self._get_builders, "builders", ids)
+
 	def get_by_id(self, builder_id):
-		return self._get_builder("SELECT * FROM builders WHERE id = %s", builder_id)
+		builder = self.backend.objects.get(Builder, builder_id)
+		if builder is None:
+			builder = self._get_builder("SELECT * FROM builders WHERE id = %s", builder_id)
+
+		return builder
 
 	def get_by_name(self, name):
 		return self._get_builder("SELECT * FROM builders \
@@ -93,6 +111,81 @@ class Builders(base.Object):
 
 		return builds
 
+	def update_keepalives(self, keepalives):
+		"""
+			Stores many keepalives at once.
+
+			Each keepalive is a tuple of (builder ID, time, loadavg1,
+			loadavg5, loadavg15, mem_total, mem_free, swap_total,
+			swap_free, space_free). All of them are appended to the
+			statistics and each builder is updated with its latest one.
+		"""
+		if not keepalives:
+			return
+
+		template = "(%s, %s::timestamp, %s::double precision, %s::double precision, \
+			%s::double precision, %s::bigint, %s::bigint, %s::bigint, %s::bigint, %s::bigint)"
+
+		latest = {}
+		for keepalive in sorted(keepalives, key=lambda k: k[1]):
+			latest[keepalive[0]] = keepalive
+
+		with self.db.transaction():
+			self.db.execute_values("UPDATE builders SET time_keepalive = v.time, \
+				loadavg1 = v.loadavg1, loadavg5 = v.loadavg5, loadavg15 = v.loadavg15, \
+				mem_total = v.mem_total, mem_free = v.mem_free, swap_total = v.swap_total, \
+				swap_free = v.swap_free, space_free = v.space_free \
+				FROM (VALUES %s) AS v(id, time, loadavg1, loadavg5, loadavg15, \
+					mem_total, mem_free, swap_total, swap_free, space_free) \
+				WHERE builders.id = v.id", latest.values(), template=template)
+
+			self.db.execute_values("INSERT INTO builders_stats(builder_id, time, \
+				loadavg1, loadavg5, loadavg15, mem_total, mem_free, swap_total, \
+				swap_free, space_free) VALUES %s", keepalives, template=template)
+
+	def rollup_stats(self):
+		"""
+			Condenses the statistics of all builders into averages per
+			minute and per hour and deletes everything that is too old
+
+			Every run computes the averages of all intervals since the last
+			one that has been rolled up for each builder (and at least of
+			the last hour or day) again, so that keepalives which have been
+			stored late are included, too.
+		"""
+		columns = ("loadavg1", "loadavg5", "loadavg15", "mem_total",
+			"mem_free", "swap_total", "swap_free", "space_free")
+
+		averages = ", ".join("AVG(%s)" % c for c in columns)
+		updates = ", ".join("%s = excluded.%s" % (c, c) for c in columns)
+
+		with self.db.transaction():
+			for source, destination, unit, lookback in (
+					("builders_stats", "builders_stats_minutely", "minute", "1 hour"),
+					("builders_stats_minutely", "builders_stats_hourly", "hour", "1 day")):
+				# Leave some time for late keepalives
+				self.db.execute("WITH last AS ( \
+						SELECT builders.id AS builder_id, ( \
+							SELECT MAX(time) FROM %s WHERE builder_id = builders.id \
+						) AS time FROM builders \
+					) \
+					INSERT INTO %s(builder_id, time, %s) \
+					SELECT source.builder_id, date_trunc('%s', source.time), %s FROM %s source \
+						LEFT JOIN last ON source.builder_id = last.builder_id \
+					WHERE source.time >= LEAST(COALESCE(last.time, '-infinity'), \
+							date_trunc('%s', NOW() - '%s'::interval)) \
+						AND source.time < date_trunc('%s', NOW() - '1 minute'::interval) \
+					GROUP BY source.builder_id, date_trunc('%s', source.time) \
+					ON CONFLICT (builder_id, time) DO UPDATE SET %s"
+					% (destination, destination, ", ".join(columns), unit, averages, source,
+						unit, lookback, unit, unit, updates))
+
+			# Delete everything that has been condensed
+			self.db.execute("DELETE FROM builders_stats \
+				WHERE time < NOW() - '1 day'::interval")
+			self.db.execute("DELETE FROM builders_stats_minutely \
+				WHERE time < NOW() - '30 days'::interval")
+
 	def get_history(self, limit=None, offset=None, builder=None, user=None):
 		query = "SELECT * FROM builders_history"
 		args  = []
@@ -163,6 +256,9 @@ class Builder(base.DataObject):
 		# Store the hash in the database.
 		self._set_attribute("passphrase", passphrase_hash)
 
+		# The old passphrase must not be accepted any more
+		self.backend.credentials.invalidate("builder", self.id)
+
 		# Return the clear-text passphrase.
 		return passphrase
 
@@ -198,11 +294,10 @@ class Builder(base.DataObject):
 		"""
 			Update the keepalive timestamp of this machine.
 		"""
-		self.db.execute("UPDATE builders SET time_keepalive = NOW(), \
-			loadavg1 = %s, loadavg5 = %s, loadavg15 = %s, space_free = %s, \
-			mem_total = %s, mem_free = %s, swap_total = %s, swap_free = %s \
-			WHERE id = %s", loadavg1, loadavg5, loadavg15, space_free,
-			mem_total, mem_free, swap_total, swap_free, self.id)
+		self.backend.builders.update_keepalives([
+			(self.id, datetime.datetime.utcnow(), loadavg1, loadavg5, loadavg15,
+				mem_total, mem_free, swap_total, swap_free, space_free),
+		])
 
 	def set_online_until(self, online_until):
 		self._set_attribute("online_until", online_until)
@@ -221,8 +316,17 @@ class Builder(base.DataObject):
 	def set_enabled(self, enabled):
 		self._set_attribute("enabled", enabled)
 
+		self.backend.credentials.invalidate("builder", self.id)
+
 	enabled = property(lambda s: s.data.enabled, set_enabled)
 
+	def set_deleted(self, deleted):
+		self._set_attribute("deleted", deleted)
+
+		self.backend.credentials.invalidate("builder", self.id)
+
+	deleted = property(lambda s: s.data.deleted, set_deleted)
+
 	@property
 	def disabled(self):
 		return not self.enabled
@@ -275,13 +379,19 @@ class Builder(base.DataObject):
 	def passphrase(self):
 		return self.data.passphrase
 
+	@property
+	def speed(self):
+		"""
+			How fast this builder builds compared to the average builder
+		"""
+		return self.backend.scheduler.get_speed(self)
+
 	@property
 	def performance_index(self):
 		"""
 			Returns a number that determines how "fast" the builder is
 		"""
-		# XXX needs to be something better
-		index = self.cpu_bogomips
+		index = self.speed
 
 		# We devide the performance index by the number of already running
 		# builds to avoid that the fastest builder always gets all the jobs
@@ -407,50 +517,26 @@ class Builder(base.DataObject):
 
 		return res.count
 
-	@property
-	def too_many_jobs(self):
+	def lock(self):
 		"""
-			Tell if this host is already running enough or too many jobs.
+			Locks this builder until the end of the current transaction,
+			so that its active jobs can be counted and added to reliably.
 		"""
-		return self.num_active_jobs >= self.max_jobs
+		self.db.execute("SELECT 1 FROM builders WHERE id = %s FOR UPDATE", self.id)
 
-	@lazy_property
-	def jobqueue(self):
-		return self.backend.jobqueue.for_arches(self.supported_arches)
-
-	def get_next_job(self):
+	@property
+	def free_slots(self):
 		"""
-			Returns the next job in line for this builder.
+			The number of jobs that this builder could start right now
 		"""
-		# Don't send any jobs to disabled builders
-		if not self.enabled:
-			return
-
-		# Don't return anything if the builder has already too many jobs running
-		if self.too_many_jobs:
-			logging.debug("%s has too many jobs running" % self)
-			return
+		return max(self.max_jobs - self.num_active_jobs, 0)
 
-		# Get all jobs from the job queue this builder can build
-		jobs = self.backend.jobqueue.for_arches(self.supported_arches)
-
-		for job in jobs:
-			logging.debug("Looking at %s..." % job)
-
-			# Only allow building test jobs in test mode
-			if self.testmode and not job.test:
-				continue
-
-			# We will skip this job if we are not the designated builder
-			if job.designated_builder and not job.designated_builder == self:
-				logging.debug("We are not the designated builder for this job (%s is)" % job.designated_builder)
-				continue
-
-			logging.debug("Bingo!")
-
-			return job
-
-		logging.debug("No eligible jobs in the job queue")
+	@property
+	def too_many_jobs(self):
+		"""
+			Tell if this host is already running enough or too many jobs.
+		"""
+		return self.num_active_jobs >= self.max_jobs
 
 	def get_history(self, *args, **kwargs):
 		kwargs["builder"] = self
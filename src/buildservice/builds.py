@@ -25,20 +25,91 @@ class Builds(base.Object):
 		if res:
 			return Build(self.backend, res.id, data=res)
 
-	def _get_builds(self, query, *args):
+	def _get_builds(self, query, *args, **kwargs):
+		prefetch = kwargs.pop("prefetch", None)
+
 		res = self.db.query(query, *args)
 
-		for row in res:
+		builds = [Build(self.backend, row.id, data=row) for row in res]
+
+		# Load all related objects at once
+		if prefetch:
+			self.prefetch(builds, prefetch)
+
+		return iter(builds)
+
+	def _iterate_builds(self, query, *args):
+		"""
+			Like _get_builds() but streams the rows from the database
+		"""
+		for row in self.db.iterate(query, *args):
 			yield Build(self.backend, row.id, data=row)
 
 	def __iter__(self):
-		builds = self._get_builds("SELECT * FROM builds ORDER BY time_created DESC")
+		builds = self._iterate_builds("SELECT * FROM builds ORDER BY time_created DESC")
 
 		return iter(builds)
 
 	def get_by_id(self, id, data=None):
 		return Build(self.backend, id, data=data)
 
+	def get_by_ids(self, ids, prefetch=None):
+		"""
+			Fetches all builds with the given IDs in one query and
+			returns them in the same order
+		"""
+		return self._get_by_ids(self._get_builds, "builds", ids, prefetch=prefetch)
+
+	def prefetch(self, builds, prefetch):
+		"""
+			Loads the given relations ("pkg", "owner", "jobs" and anything
+			below "jobs." like "jobs.builder") of all builds with one query
+			per relation and stores them in the lazy properties
+		"""
+		builds = list(builds)
+		if not builds:
+			return builds
+
+		for relation, nested in base.split_prefetch(prefetch).items():
+			if relation == "pkg":
+				pkgs = self.backend.packages.get_by_ids(
+					list(set(b.data.pkg_id for b in builds)))
+				pkgs = dict((p.id, p) for p in pkgs)
+
+				for build in builds:
+					Build.pkg.prime(build, pkgs.get(build.data.pkg_id))
+
+			elif relation == "owner":
+				users = self.backend.users.get_by_ids(
+					list(set(b.data.owner_id for b in builds if b.data.owner_id)))
+				users = dict((u.id, u) for u in users)
+
+				for build in builds:
+					Build.owner.prime(build, users.get(build.data.owner_id))
+
+			elif relation == "jobs":
+				jobs = {}
+				for build in builds:
+					jobs[build.id] = []
+
+				res = self.backend.jobs._get_jobs("SELECT * FROM jobs \
+					WHERE build_id = ANY(%s) AND test IS FALSE",
+					[b.id for b in builds], prefetch=nested)
+
+				for job in res:
+					jobs[job.data.build_id].append(job)
+
+				for build in builds:
+					for job in jobs[build.id]:
+						job.build = build
+
+					Build.jobs.prime(build, jobs[build.id])
+
+			else:
+				raise ValueError("Cannot prefetch %s of builds" % relation)
+
+		return builds
+
 	def get_by_uuid(self, uuid):
 		build = self.db.get("SELECT id FROM builds WHERE uuid = %s LIMIT 1", uuid)
 
@@ -104,7 +175,7 @@ class Builds(base.Object):
 		query += " LIMIT %s OFFSET %s"
 		args.extend([offset, limit])
 
-		return [Build(self.backend, b.id, b) for b in self.db.query(query, *args)]
+		return list(self._get_builds(query, *args, prefetch=("pkg", "owner")))
 
 	def get_latest_by_name(self, name):
 		return self._get_build("SELECT builds.* FROM builds \
@@ -260,10 +331,7 @@ class Builds(base.Object):
 		query += " LIMIT %s OFFSET %s"
 		args += [offset, limit]
 
-		builds = []
-		for b in self.db.query(query, *args):
-			b = Build(self.backend, b.id, b)
-			builds.append(b)
+		builds = list(self._get_builds(query, *args, prefetch=("pkg", "owner")))
 
 		builds.sort(reverse=True)
 
@@ -1010,15 +1078,7 @@ class Build(base.DataObject):
 			self.log("bug_removed", user=user, bug_id=bug_id)
 
 	def get_bugs(self):
-		bugs = []
-		for bug_id in self.get_bug_ids():
-			bug = self.backend.bugzilla.get_bug(bug_id)
-			if not bug:
-				continue
-
-			bugs.append(bug)
-
-		return bugs
+		return self.backend.bugzilla.get_bugs(self.get_bug_ids())
 
 	def _update_bugs_helper(self, repo):
 		"""
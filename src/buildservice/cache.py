@@ -1,7 +1,13 @@
 #!/usr/bin/python
 
+import collections
+import copy
+import hashlib
+import hmac
 import logging
 import memcache
+import threading
+import time
 
 from . import base
 
@@ -10,34 +16,224 @@ from .decorators import *
 log = logging.getLogger("cache")
 log.propagate = 1
 
+# Marks keys that are known to be missing
+MISSING = object()
+
+def _copy(val):
+	# MISSING must stay the same object
+	if val is MISSING:
+		return val
+
+	return copy.deepcopy(val)
+
+
 class Client(memcache.Client):
 	def debuglog(self, str):
 		log.debug(str)
 
 
+class LRU(object):
+	"""
+		A small, thread-safe in-process cache that holds up to
+		maxsize keys and expires each of them after its own TTL.
+
+		Values are copied when they are stored and returned, so that
+		callers can never change what other callers get.
+	"""
+	def __init__(self, maxsize=1024):
+		self.maxsize = maxsize
+
+		self._items = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._items)
+
+	def get(self, key, default=None):
+		with self._lock:
+			try:
+				expires_at, val = self._items.pop(key)
+			except KeyError:
+				return default
+
+			# Drop expired keys
+			if expires_at < time.time():
+				return default
+
+			# Move the key to the end, it has been used recently
+			self._items[key] = (expires_at, val)
+
+		return _copy(val)
+
+	def set(self, key, val, ttl):
+		val = _copy(val)
+
+		with self._lock:
+			self._items.pop(key, None)
+			self._items[key] = (time.time() + ttl, val)
+
+			# Evict the least recently used keys
+			while len(self._items) > self.maxsize:
+				self._items.popitem(last=False)
+
+	def delete(self, key):
+		with self._lock:
+			self._items.pop(key, None)
+
+	def delete_where(self, func):
+		"""
+			Deletes all keys for which func(key, value) is true
+		"""
+		with self._lock:
+			for key, (expires_at, val) in self._items.items():
+				if func(key, val):
+					del self._items[key]
+
+	def clear(self):
+		with self._lock:
+			self._items.clear()
+
+
+class CredentialCache(object):
+	"""
+		Remembers which credentials have recently been verified
+		so that the password hash does not have to be checked (and
+		the database not to be asked) on every single request.
+
+		Only a digest of the secret and the ID of the object are kept,
+		so that callers always load the current row from the database.
+		Since other processes cannot invalidate this cache, entries
+		expire after a short time.
+	"""
+	def __init__(self, ttl=60, maxsize=1024):
+		self.ttl = ttl
+
+		self._cache = LRU(maxsize=maxsize)
+
+	@staticmethod
+	def _digest(secret):
+		if isinstance(secret, unicode):
+			secret = secret.encode("utf-8")
+
+		return hashlib.sha512(secret).hexdigest()
+
+	def get(self, kind, name, secret):
+		"""
+			Returns the ID that has been stored for these credentials
+		"""
+		entry = self._cache.get((kind, name))
+		if entry is None:
+			return
+
+		digest, id = entry
+
+		if hmac.compare_digest(digest, self._digest(secret)):
+			return id
+
+	def set(self, kind, name, secret, id):
+		self._cache.set((kind, name), (self._digest(secret), id), self.ttl)
+
+	def invalidate(self, kind, id):
+		"""
+			Forgets all credentials of the object with the given ID
+		"""
+		self._cache.delete_where(lambda key, entry: key[0] == kind and entry[1] == id)
+
+
 class Cache(base.Object):
 	key_prefix = "pbs_"
 
+	# Keys are kept in this process for at most this many seconds
+	# so that changes from other processes become visible soon
+	local_ttl = 30
+
+	# Keys that memcache does not have are remembered for this long
+	negative_ttl = 5
+
+	def init(self):
+		self._local = LRU(maxsize=4096)
+
 	@lazy_property
 	def _cache(self):
 		logging.debug("Connecting to memcache...")
 
 		return Client(["localhost:11211"], debug=1)
 
+	def _remember(self, key, val, lifetime):
+		if val is None:
+			ttl = self.negative_ttl
+			val = MISSING
+		else:
+			ttl = self.local_ttl
+
+			# Never keep anything longer than memcache does
+			if lifetime:
+				ttl = min(ttl, int(lifetime))
+
+		self._local.set(key, val, ttl)
+
 	def get(self, key):
+		val = self._local.get(key)
+
+		if val is MISSING:
+			return
+		elif val is not None:
+			return val
+
 		log.debug("Querying for: %s" % key)
 
-		key = "".join((self.key_prefix, key))
+		val = self._cache.get("".join((self.key_prefix, key)))
+		self._remember(key, val, None)
 
-		return self._cache.get(key)
+		return val
+
+	def get_multi(self, keys):
+		"""
+			Returns a dictionary with all of the given keys that
+			could be found in the cache
+		"""
+		res, missing = {}, []
+
+		for key in keys:
+			val = self._local.get(key)
+
+			if val is MISSING:
+				continue
+			elif val is None:
+				missing.append(key)
+			else:
+				res[key] = val
+
+		if missing:
+			log.debug("Querying for: %s" % ", ".join(missing))
+
+			vals = self._cache.get_multi(missing, key_prefix=self.key_prefix)
+
+			for key in missing:
+				val = vals.get(key)
+				self._remember(key, val, None)
+
+				if val is not None:
+					res[key] = val
+
+		return res
 
 	def set(self, key, val, time=60, min_compress_len=0):
-		key = "".join((self.key_prefix, key))
+		self._remember(key, val, time)
 
-		return self._cache.set(key, val, time=time,
-			min_compress_len=min_compress_len)
+		return self._cache.set("".join((self.key_prefix, key)), val,
+			time=time, min_compress_len=min_compress_len)
+
+	def set_multi(self, mapping, time=60, min_compress_len=0):
+		for key, val in mapping.items():
+			self._remember(key, val, time)
+
+		return self._cache.set_multi(mapping, time=time,
+			key_prefix=self.key_prefix, min_compress_len=min_compress_len)
 
 	def delete(self, key, time=0):
+		self._local.delete(key)
+
 		key = "".join((self.key_prefix, key))
 
 		return self._cache.delete(key, time=time)
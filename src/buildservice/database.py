@@ -10,9 +10,18 @@
 
 from __future__ import absolute_import, division, with_statement
 
+import collections
+import concurrent.futures
+import contextlib
 import itertools
 import logging
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+import re
+import threading
+import time
 
 class Connection(object):
 	"""
@@ -31,53 +40,224 @@ class Connection(object):
 		We explicitly set the timezone to UTC and the character encoding to
 		UTF-8 on all connections to avoid time zone and encoding errors.
 	"""
-	def __init__(self, host, database, user=None, password=None):
+	def __init__(self, host, database, user=None, password=None,
+			min_connections=1, max_connections=4, fetch_size=1000, prepare_threshold=3,
+			slow_query_threshold=0, replica=None):
 		self.host = host
 		self.database = database
 
-		self._db = None
-		self._db_args = {
+		# A read-only replica (another Connection) that runs the reads
+		# of threads that have been marked as read-only
+		self.replica = replica
+
+		# After the replica has failed, all reads go to the primary
+		# for this many seconds
+		self.replica_retry_interval = 30
+		self._replica_failed_at = None
+
+		# Number of rows that iterate() fetches at once
+		self.fetch_size = fetch_size
+
+		# At least two connections are needed, so that the calling thread
+		# can always get a connection while run_async() is using the others
+		self.min_connections = max(min_connections, 0)
+		self.max_connections = max(max_connections, self.min_connections, 2)
+
+		self._pool = None
+		self._pool_args = {
 			"host"     : host,
 			"database" : database,
 			"user"     : user,
 			"password" : password,
-                        "sslmode"  : "require",
+			"sslmode"  : "require",
+
+			# Remembers the statements that have been prepared
+			"connection_factory" : PreparingConnection,
 		}
 
-		try:
-			self.reconnect()
-		except Exception:
-			logging.error("Cannot connect to database on %s", self.host, exc_info=True)
+		# Statements are prepared after they have been executed this often
+		# (0 disables preparing statements)
+		self.prepare_threshold = prepare_threshold
+
+		# Counts how often each statement has been executed
+		# (for at most max_executions different statements)
+		self._executions = collections.OrderedDict()
+		self._prepare_lock = threading.Lock()
+
+		# Statements that the server refused to prepare
+		self._unpreparable = set()
+
+		# Statistics for the statement cache
+		self.prepared_hits = 0
+		self.prepared_misses = 0
+
+		# Queries that take longer than this (in milliseconds) are logged
+		# together with their query plan (0 disables the slow query log)
+		self.slow_query_threshold = slow_query_threshold
+
+		# Latency statistics for each (normalised) statement
+		self._stats = {}
+		self._normalised = {}
+		self._stats_lock = threading.Lock()
+
+		# Limits how many connections may be checked out at the same time.
+		# Threads will block here until a connection becomes available.
+		self._slots = threading.BoundedSemaphore(self.max_connections)
+
+		# Holds the connection that is pinned to the current thread
+		# while a transaction is open
+		self._local = threading.local()
+
+		# Used to generate unique names for server-side cursors
+		self._cursor_ids = itertools.count()
+
+		# Number of iterators that hold a connection of their own
+		self._iterators = 0
+		self._iterators_lock = threading.Lock()
+
+		# Threads that run asynchronous queries
+		self._executor = None
+		self._executor_lock = threading.Lock()
+
+		# The pool is opened when the first connection is needed
+		self._pool_lock = threading.Lock()
 
 	def __del__(self):
 		self.close()
 
 	def close(self):
 		"""
-			Closes this database connection.
+			Closes all connections in the pool.
 		"""
-		if getattr(self, "_db", None) is not None:
-			self._db.close()
-			self._db = None
+		if getattr(self, "_pool", None) is not None:
+			self._pool.closeall()
+			self._pool = None
 
 	def reconnect(self):
 		"""
-			Closes the existing database connection and re-opens it.
+			Closes all existing connections and opens a new pool.
 		"""
 		self.close()
 
-		self._db = psycopg2.connect(**self._db_args)
-		self._db.autocommit = True
+		self._pool = psycopg2.pool.ThreadedConnectionPool(
+			self.min_connections, self.max_connections, **self._pool_args)
 
 	def query(self, query, *parameters, **kwparameters):
 		"""
 			Returns a row list for the given query and parameters.
 		"""
-		cursor = self._cursor()
+		db = self._route(query)
+		if db is not self:
+			try:
+				with db.counting(self.counter):
+					return db.query(query, *parameters, **kwparameters)
+
+			# Run the query on the primary instead
+			except OperationalError:
+				self._replica_failed()
+
+		with self._cursor() as cursor:
+			self._execute(cursor, query, parameters, kwparameters)
+			columns = Row.columns(cursor)
+			return [Row(columns, row) for row in cursor]
+
+	def iterate(self, query, *parameters, **kwparameters):
+		"""
+			Returns an iterator over all rows for the given query.
+
+			The rows are fetched from a server-side cursor in batches
+			of fetch_size rows, so that large results are never loaded
+			into memory at once.
+
+			Inside a transaction, the cursor is part of it. Otherwise it
+			runs in a transaction of its own on a connection that is taken
+			from the pool only for this iterator, so that any statements
+			that the caller runs meanwhile are not affected by it. That
+			transaction is only committed when all rows have been read.
+
+			Statements in the loop need another connection. Therefore at
+			most max_connections - 1 iterators hold a connection at the
+			same time. If there are already that many, all rows are
+			fetched at once like query() does.
+		"""
+		db = self._route(query)
+		if db is not self:
+			rows = 0
+
+			try:
+				with db.counting(self.counter):
+					for row in db.iterate(query, *parameters, **kwparameters):
+						rows += 1
+						yield row
+
+				return
+
+			# Run the query on the primary instead unless
+			# the caller has already received some rows
+			except OperationalError:
+				if rows:
+					raise
+
+				self._replica_failed()
+
+		# Use the connection of the running transaction
+		conn = self._pinned
+		if conn is not None:
+			for row in self._iterate(conn, query, parameters, kwparameters):
+				yield row
+
+			return
+
+		# Always leave one connection for anything that runs in the loop
+		with self._iterators_lock:
+			streaming = self._iterators < self.max_connections - 1
+
+			if streaming:
+				self._iterators += 1
+
+		if not streaming:
+			for row in self.query(query, *parameters, **kwparameters):
+				yield row
+
+			return
+
+		try:
+			conn = self._checkout()
+			conn.autocommit = False
+
+			commit = False
+			try:
+				for row in self._iterate(conn, query, parameters, kwparameters):
+					yield row
+
+				commit = True
+
+			finally:
+				try:
+					if commit:
+						conn.commit()
+					else:
+						conn.rollback()
+				finally:
+					self._checkin(conn)
+
+		finally:
+			with self._iterators_lock:
+				self._iterators -= 1
+
+	def _iterate(self, conn, query, parameters, kwparameters):
+		cursor = conn.cursor("iterate_%s" % next(self._cursor_ids))
+		cursor.itersize = self.fetch_size
+
 		try:
 			self._execute(cursor, query, parameters, kwparameters)
-			column_names = [d[0] for d in cursor.description]
-			return [Row(itertools.izip(column_names, row)) for row in cursor]
+
+			columns = None
+			for row in cursor:
+				if columns is None:
+					columns = Row.columns(cursor)
+
+				yield Row(columns, row)
 		finally:
 			cursor.close()
 
@@ -103,23 +283,17 @@ class Connection(object):
 		"""
 			Executes the given query, returning the lastrowid from the query.
 		"""
-		cursor = self._cursor()
-		try:
+		with self._cursor() as cursor:
 			self._execute(cursor, query, parameters, kwparameters)
 			return cursor.lastrowid
-		finally:
-			cursor.close()
 
 	def execute_rowcount(self, query, *parameters, **kwparameters):
 		"""
 			Executes the given query, returning the rowcount from the query.
 		"""
-		cursor = self._cursor()
-		try:
+		with self._cursor() as cursor:
 			self._execute(cursor, query, parameters, kwparameters)
 			return cursor.rowcount
-		finally:
-			cursor.close()
 
 	def executemany(self, query, parameters):
 		"""
@@ -135,12 +309,11 @@ class Connection(object):
 
 			We return the lastrowid from the query.
 		"""
-		cursor = self._cursor()
-		try:
-			cursor.executemany(query, parameters)
+		self._local.wrote = True
+
+		with self._cursor() as cursor:
+			self._executemany(cursor, query, parameters)
 			return cursor.lastrowid
-		finally:
-			cursor.close()
 
 	def executemany_rowcount(self, query, parameters):
 		"""
@@ -148,59 +321,789 @@ class Connection(object):
 
 			We return the rowcount from the query.
 		"""
-		cursor = self._cursor()
+		self._local.wrote = True
 
-		try:
-			cursor.executemany(query, parameters)
+		with self._cursor() as cursor:
+			self._executemany(cursor, query, parameters)
 			return cursor.rowcount
-		finally:
-			cursor.close()
+
+	def execute_values(self, query, parameters, template=None, page_size=1000):
+		"""
+			Inserts many rows with only a few statements.
+
+			The query must contain a single "VALUES %s" placeholder which
+			is expanded into a multi-row VALUES list of up to page_size
+			of the given param sequences per statement. Each row is
+			formatted according to template (i.e. to add type casts).
+		"""
+		self._local.wrote = True
+
+		with self._cursor() as cursor:
+			t = time.time()
+
+			psycopg2.extras.execute_values(cursor, query, parameters,
+				template=template, page_size=page_size)
+
+			self._record(cursor, query, None, time.time() - t)
+
+	def _executemany(self, cursor, query, parameters):
+		t = time.time()
+
+		cursor.executemany(query, parameters)
+
+		self._record(cursor, query, None, time.time() - t)
+
+	def listen(self, *channels):
+		"""
+			Opens a new connection outside of the pool that listens
+			on the given channels.
+
+			The caller is responsible for polling it (i.e. when its
+			file descriptor becomes readable) and for closing it.
+		"""
+		conn = psycopg2.connect(**self._pool_args)
+		conn.autocommit = True
+
+		with contextlib.closing(conn.cursor()) as cursor:
+			for channel in channels:
+				cursor.execute("LISTEN %s" % channel)
+
+		return conn
+
+	def set_read_only(self, read_only):
+		"""
+			Marks the current thread as (not) read-only.
+
+			Reads of read-only threads are sent to the replica until
+			the thread writes something or opens a transaction, so that
+			it always reads its own writes.
+		"""
+		self._local.read_only = read_only
+		self._local.wrote = False
+
+	def _route(self, query):
+		"""
+			Returns the connection that should run query
+		"""
+		if self.replica is None:
+			return self
+
+		if not getattr(self._local, "read_only", False):
+			return self
+
+		# Read your own writes
+		if getattr(self._local, "wrote", False) or self._pinned is not None:
+			return self
+
+		if not self._is_read_only_query(query):
+			return self
+
+		# Give the replica some time to come back after it has failed
+		failed_at = self._replica_failed_at
+		if failed_at and time.time() - failed_at < self.replica_retry_interval:
+			return self
+
+		return self.replica
+
+	def _replica_failed(self):
+		logging.error("Could not read from the replica on %s, using the primary"
+			% self.replica.host, exc_info=True)
+
+		self._replica_failed_at = time.time()
+
+	# Matches row locks which only the primary can take
+	_row_locks = re.compile(r"\bFOR\s+(NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b", re.I)
+
+	# Matches functions that change something
+	_writing_functions = re.compile(r"\b(nextval|setval|pg_notify|pg_advisory_\w+)\s*\(", re.I)
+
+	def _is_read_only_query(self, query):
+		if not query.lstrip()[:6].upper() == "SELECT":
+			return False
+
+		if self._row_locks.search(query):
+			return False
+
+		return self._writing_functions.search(query) is None
+
+	@property
+	def executor(self):
+		"""
+			The thread pool that runs all asynchronous queries.
+
+			It is one thread smaller than the connection pool so that every
+			thread can hold a connection and one is left for the caller.
+		"""
+		with self._executor_lock:
+			if self._executor is None:
+				self._executor = concurrent.futures.ThreadPoolExecutor(
+					max_workers=self.max_connections - 1)
+
+			return self._executor
+
+	def run_async(self, callback, *args, **kwargs):
+		"""
+			Calls callback in a background thread and returns a future
+			that resolves to its result.
+
+			This can be yielded from a tornado.gen coroutine. All database
+			access of callback happens in the background thread, so it has
+			to start its own transactions if it needs any.
+		"""
+		return self.executor.submit(callback, *args, **kwargs)
+
+	def query_async(self, query, *parameters, **kwparameters):
+		"""
+			Like query() but returns a future.
+		"""
+		return self.run_async(self.query, query, *parameters, **kwparameters)
+
+	def get_async(self, query, *parameters, **kwparameters):
+		"""
+			Like get() but returns a future.
+		"""
+		return self.run_async(self.get, query, *parameters, **kwparameters)
+
+	def execute_async(self, query, *parameters, **kwparameters):
+		"""
+			Like execute() but returns a future.
+		"""
+		return self.run_async(self.execute, query, *parameters, **kwparameters)
+
+	def execute_rowcount_async(self, query, *parameters, **kwparameters):
+		"""
+			Like execute_rowcount() but returns a future.
+		"""
+		return self.run_async(self.execute_rowcount, query, *parameters, **kwparameters)
 
 	def _ensure_connected(self):
-		if self._db is None:
-			self.reconnect()
+		if self._pool is None:
+			with self._pool_lock:
+				if self._pool is None:
+					self.reconnect()
 
-	def _cursor(self):
+	def _checkout(self):
+		"""
+			Takes a healthy connection from the pool.
+		"""
 		self._ensure_connected()
-		return self._db.cursor()
+
+		self._slots.acquire()
+		try:
+			while True:
+				conn = self._pool.getconn()
+
+				if self._is_healthy(conn):
+					break
+
+				logging.warning("Discarding broken database connection to %s", self.host)
+				self._pool.putconn(conn, close=True)
+
+			# Run every statement in its own transaction unless
+			# a transaction is explicitly started
+			if not conn.autocommit:
+				conn.autocommit = True
+
+			return conn
+
+		except:
+			self._slots.release()
+			raise
+
+	def _checkin(self, conn, close=False):
+		"""
+			Returns a connection to the pool.
+		"""
+		try:
+			if self._pool is not None:
+				self._pool.putconn(conn, close=close or not self._is_healthy(conn))
+		finally:
+			self._slots.release()
+
+	@staticmethod
+	def _is_healthy(conn):
+		if conn.closed:
+			return False
+
+		status = conn.get_transaction_status()
+
+		# The connection must not be lost or left in a transaction
+		return status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+	@property
+	def _pinned(self):
+		return getattr(self._local, "conn", None)
+
+	@contextlib.contextmanager
+	def _connection(self):
+		"""
+			Yields the connection of the running transaction or
+			borrows one from the pool for the duration of the block.
+		"""
+		conn = self._pinned
+		if conn is not None:
+			yield conn
+			return
+
+		conn = self._checkout()
+		try:
+			yield conn
+		finally:
+			self._checkin(conn)
+
+	@contextlib.contextmanager
+	def _cursor(self):
+		with self._connection() as conn:
+			cursor = conn.cursor()
+			try:
+				yield cursor
+			finally:
+				cursor.close()
 
 	def _execute(self, cursor, query, parameters, kwparameters):
-		logging.debug("Executing SQL: %s" % (query % (kwparameters or parameters)))
+		if logging.getLogger().isEnabledFor(logging.DEBUG):
+			logging.debug("Executing SQL: %s" % (query % (kwparameters or parameters)))
+
+		# Send all further reads of this thread to the primary
+		if not self._is_read_only_query(query):
+			self._local.wrote = True
+
+		statement = query
+
+		# Use a prepared statement if possible
+		if not kwparameters:
+			name = self._prepare(cursor, query)
+
+			if name:
+				statement = "EXECUTE %s" % name
+				if parameters:
+					statement += "(%s)" % ", ".join("%s" for p in parameters)
+
+		t = time.time()
 
 		try:
-			return cursor.execute(query, kwparameters or parameters)
+			ret = cursor.execute(statement, kwparameters or parameters)
 		except OperationalError:
 			logging.error("Error connecting to database on %s", self.host)
-			self.close()
 			raise
 
+		self._record(cursor, query, kwparameters or parameters, time.time() - t)
+
+		return ret
+
+	def _record(self, cursor, query, parameters, duration):
+		"""
+			Accounts duration (in seconds) to the statistics of query
+			and to the query counter of the current thread.
+
+			parameters is None for statements that have been executed
+			with many parameter sequences at once.
+		"""
+		normalised = self._normalise(query)
+
+		with self._stats_lock:
+			try:
+				stats = self._stats[normalised]
+			except KeyError:
+				stats = self._stats[normalised] = QueryStats(normalised)
+
+			stats.add(duration)
+
+		counter = self.counter
+		if counter is not None:
+			counter.add(duration)
+
+		if self.slow_query_threshold and duration * 1000 >= self.slow_query_threshold:
+			logging.warning("Slow query (%.1fms): %s -- parameters: %r"
+				% (duration * 1000, normalised, parameters))
+
+			if parameters is not None and not cursor.name:
+				# EXPLAIN ANALYZE runs the query again, so only do this
+				# for queries that cannot change or lock anything
+				analyze = self._is_read_only_query(query)
+
+				plan = self._explain(cursor.connection, query, parameters, analyze=analyze)
+
+				if plan:
+					logging.warning("Query plan:\n%s" % plan)
+
+	def _explain(self, conn, query, parameters, analyze=False):
+		"""
+			Returns the query plan of query (with the actual
+			run times if analyze is True)
+		"""
+		# A failed EXPLAIN must not abort a running transaction
+		in_transaction = conn.get_transaction_status() \
+			== psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+
+		with contextlib.closing(conn.cursor()) as cursor:
+			if in_transaction:
+				cursor.execute("SAVEPOINT explain")
+
+			try:
+				if analyze:
+					cursor.execute("EXPLAIN (ANALYZE, BUFFERS) %s" % query, parameters)
+				else:
+					cursor.execute("EXPLAIN %s" % query, parameters)
+
+				return "\n".join(row[0] for row in cursor)
+
+			except psycopg2.Error as e:
+				logging.debug("Could not explain query: %s" % e)
+
+				if in_transaction:
+					cursor.execute("ROLLBACK TO SAVEPOINT explain")
+
+			finally:
+				if in_transaction:
+					cursor.execute("RELEASE SAVEPOINT explain")
+
+	# Matches runs of whitespace, string literals and numbers
+	_whitespace = re.compile(r"\s+")
+	_literals = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+
+	def _normalise(self, query):
+		"""
+			Returns query in one line and without any literals so that
+			all executions of the same statement are counted together
+		"""
+		try:
+			return self._normalised[query]
+		except KeyError:
+			pass
+
+		normalised = self._whitespace.sub(" ", query).strip()
+		normalised = self._literals.sub("?", normalised)
+
+		# Do not grow without bounds on generated queries
+		if len(self._normalised) < 4096:
+			self._normalised[query] = normalised
+
+		return normalised
+
+	@property
+	def query_stats(self):
+		"""
+			Returns the statistics of all statements that have been
+			executed, the ones that took the most time in total first
+		"""
+		with self._stats_lock:
+			stats = [s.copy() for s in self._stats.values()]
+
+		return sorted(stats, key=lambda s: s.total, reverse=True)
+
+	@property
+	def counter(self):
+		"""
+			The QueryCounter of the current thread (or None)
+		"""
+		return getattr(self._local, "counter", None)
+
+	def begin_counting(self, counter=None):
+		"""
+			Counts all queries of the current thread from now on
+			and returns the QueryCounter
+		"""
+		if counter is None:
+			counter = QueryCounter()
+
+		self._local.counter = counter
+
+		return counter
+
+	def end_counting(self):
+		self._local.counter = None
+
+	@contextlib.contextmanager
+	def counting(self, counter):
+		"""
+			Counts all queries of the current thread in the block
+			into counter
+		"""
+		previous = self.counter
+
+		self._local.counter = counter
+		try:
+			yield counter
+		finally:
+			self._local.counter = previous
+
+	@property
+	def statement_cache_stats(self):
+		"""
+			Returns how often prepared statements have been used (hits)
+			and how often a statement had to be sent in full (misses).
+		"""
+		return {
+			"hits"   : self.prepared_hits,
+			"misses" : self.prepared_misses,
+		}
+
+	# Execution counts are kept for this many different statements
+	max_executions = 1024
+
+	def _prepare(self, cursor, query):
+		"""
+			Returns the name of the prepared statement for query on
+			the connection of cursor.
+
+			Statements are prepared once they have been executed
+			prepare_threshold times.
+		"""
+		# Server-side cursors cannot run prepared statements
+		if not self.prepare_threshold or cursor.name:
+			return
+
+		conn = cursor.connection
+
+		# Hit
+		name = conn.statements.get(query)
+		if name:
+			with self._prepare_lock:
+				self.prepared_hits += 1
+
+			return name
+
+		if not self._is_preparable(query):
+			return
+
+		with self._prepare_lock:
+			self.prepared_misses += 1
+
+			executions = self._executions.pop(query, 0) + 1
+			self._executions[query] = executions
+
+			# Forget the statements that have not been seen for the longest time
+			while len(self._executions) > self.max_executions:
+				self._executions.popitem(last=False)
+
+		if executions < self.prepare_threshold:
+			return
+
+		if len(conn.statements) >= conn.max_statements:
+			return
+
+		# Convert the placeholders into PostgreSQL syntax
+		name = "statement_%s" % len(conn.statements)
+		statement = self._placeholders.sub(self._convert_placeholder(), query)
+
+		# A failed PREPARE must not abort a running transaction
+		in_transaction = conn.get_transaction_status() \
+			== psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+
+		if in_transaction:
+			cursor.execute("SAVEPOINT prepare")
+
+		try:
+			cursor.execute("PREPARE %s AS %s" % (name, statement))
+
+		except psycopg2.Error as e:
+			logging.debug("Could not prepare statement: %s" % e)
+
+			# Don't try again if the server does not accept the statement
+			if isinstance(e, psycopg2.ProgrammingError):
+				self._unpreparable.add(query)
+
+			if in_transaction:
+				cursor.execute("ROLLBACK TO SAVEPOINT prepare")
+				cursor.execute("RELEASE SAVEPOINT prepare")
+
+			return
+
+		if in_transaction:
+			cursor.execute("RELEASE SAVEPOINT prepare")
+
+		logging.debug("Prepared statement %s: %s" % (name, statement))
+		conn.statements[query] = name
+
+		return name
+
+	# Matches escaped percent signs and positional placeholders
+	_placeholders = re.compile(r"%%|%s")
+
+	@staticmethod
+	def _convert_placeholder():
+		"""
+			Returns a function that turns the placeholders of a
+			statement into $1, $2, ...
+		"""
+		counter = itertools.count(1)
+
+		def convert(match):
+			if match.group(0) == "%%":
+				return "%"
+
+			return "$%s" % next(counter)
+
+		return convert
+
+	def _is_preparable(self, query):
+		if query in self._unpreparable:
+			return False
+
+		# Named parameters and multiple statements are not supported
+		if "%(" in query or ";" in query:
+			return False
+
+		try:
+			command = query.split(None, 1)[0].upper()
+		except IndexError:
+			return False
+
+		return command in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+	def _begin(self):
+		"""
+			Opens a transaction or, if one is already running
+			in this thread, a savepoint inside of it.
+		"""
+		depth = getattr(self._local, "depth", 0)
+
+		if not depth:
+			conn = self._checkout()
+
+			try:
+				with contextlib.closing(conn.cursor()) as cursor:
+					cursor.execute("START TRANSACTION")
+			except:
+				self._checkin(conn, close=True)
+				raise
+
+			self._local.conn = conn
+		else:
+			with self._cursor() as cursor:
+				cursor.execute("SAVEPOINT transaction_%s" % depth)
+
+		self._local.depth = depth + 1
+
+		return self._local.depth
+
+	def _end(self, commit=True):
+		"""
+			Commits or rolls back the innermost transaction or savepoint.
+		"""
+		depth = self._local.depth - 1
+
+		if depth:
+			try:
+				with self._cursor() as cursor:
+					if commit:
+						cursor.execute("RELEASE SAVEPOINT transaction_%s" % depth)
+					else:
+						cursor.execute("ROLLBACK TO SAVEPOINT transaction_%s" % depth)
+			finally:
+				self._local.depth = depth
+
+			return
+
+		conn = self._local.conn
+
+		# Unpin the connection before anything can fail
+		self._local.conn, self._local.depth = None, 0
+
+		try:
+			with contextlib.closing(conn.cursor()) as cursor:
+				cursor.execute("COMMIT" if commit else "ROLLBACK")
+		finally:
+			self._checkin(conn)
+
 	def transaction(self):
 		return Transaction(self)
 
 
-class Row(dict):
-	"""A dict that allows for object-like property access syntax."""
+class QueryStats(object):
+	"""
+		Counts how often a statement has been executed and how
+		long that took in a histogram.
+	"""
+	# Upper bounds of the buckets in milliseconds
+	buckets = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+	def __init__(self, query):
+		self.query = query
+
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+		# The last bucket holds everything that is slower
+		self.histogram = [0] * (len(self.buckets) + 1)
+
+	def __repr__(self):
+		return "<%s %s (%s, %.1fms)>" % (self.__class__.__name__,
+			self.query, self.count, self.total * 1000)
+
+	def add(self, duration):
+		self.count += 1
+		self.total += duration
+		self.max = max(self.max, duration)
+
+		ms = duration * 1000
+
+		for i, bucket in enumerate(self.buckets):
+			if ms <= bucket:
+				break
+		else:
+			i = len(self.buckets)
+
+		self.histogram[i] += 1
+
+	def copy(self):
+		stats = QueryStats(self.query)
+
+		stats.count = self.count
+		stats.total = self.total
+		stats.max = self.max
+		stats.histogram = self.histogram[:]
+
+		return stats
+
+	@property
+	def average(self):
+		if self.count:
+			return self.total / self.count
+
+
+class QueryCounter(object):
+	"""
+		Counts the queries (and the time spent on them) that
+		were executed on behalf of one request.
+	"""
+	def __init__(self):
+		self.queries = 0
+		self.time = 0.0
+
+		# Queries might be running in several threads
+		self._lock = threading.Lock()
+
+	def add(self, duration):
+		with self._lock:
+			self.queries += 1
+			self.time += duration
+
+	@property
+	def server_timing(self):
+		"""
+			Returns the value for a Server-Timing header
+		"""
+		return "db;dur=%.1f;desc=\"%s queries\"" % (self.time * 1000, self.queries)
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+	"""
+		A psycopg2 connection that knows its prepared statements.
+	"""
+	# The maximum number of statements to prepare per connection
+	max_statements = 256
+
+	def __init__(self, *args, **kwargs):
+		psycopg2.extensions.connection.__init__(self, *args, **kwargs)
+
+		# Maps queries to the names of their prepared statements
+		self.statements = {}
+
+
+class Row(object):
+	"""
+		A row that allows for dict- and object-like access to its columns.
+
+		All rows of a query share one mapping from column names to
+		positions, so that each row only needs to hold its values.
+	"""
+	__slots__ = ("_columns", "_values")
+
+	def __init__(self, columns, values):
+		self._columns = columns
+		self._values  = values
+
+	@staticmethod
+	def columns(cursor):
+		"""
+			Returns the mapping of column names to positions for
+			the result of the last query on cursor.
+		"""
+		return dict((d[0], i) for i, d in enumerate(cursor.description))
+
+	def __repr__(self):
+		return "<%s %s>" % (self.__class__.__name__, dict(self.items()))
+
 	def __getattr__(self, name):
+		# Never look up the slots themselves as columns
+		if name in Row.__slots__:
+			raise AttributeError(name)
+
 		try:
 			return self[name]
 		except KeyError:
 			raise AttributeError(name)
 
+	def __getitem__(self, key):
+		return self._values[self._columns[key]]
+
+	def __setitem__(self, key, value):
+		# Copy the values before changing them for the first time
+		if isinstance(self._values, tuple):
+			self._values = list(self._values)
+
+		try:
+			self._values[self._columns[key]] = value
+
+		# New columns must not change the mapping of all other rows
+		except KeyError:
+			self._columns = self._columns.copy()
+			self._columns[key] = len(self._values)
+
+			self._values.append(value)
+
+	def __contains__(self, key):
+		return key in self._columns
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self):
+		return len(self._columns)
+
+	def __getstate__(self):
+		return self._columns, self._values
+
+	def __setstate__(self, state):
+		self._columns, self._values = state
+
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	def keys(self):
+		return sorted(self._columns, key=self._columns.get)
+
+	def values(self):
+		return [self[key] for key in self.keys()]
+
+	def items(self):
+		return [(key, self[key]) for key in self.keys()]
+
 
 class Transaction(object):
+	"""
+		Runs all statements of the current thread on the same connection
+		until the transaction is finished.
+
+		Transactions can be nested. Inner transactions are savepoints
+		that are rolled back on their own if an exception is raised.
+	"""
 	def __init__(self, db):
 		self.db = db
 
-		self.db.execute("START TRANSACTION")
+		self.db._begin()
 
 	def __enter__(self):
 		return self
 
 	def __exit__(self, exctype, excvalue, traceback):
-		if exctype is not None:
-			self.db.execute("ROLLBACK")
-		else:
-			self.db.execute("COMMIT")
+		self.db._end(commit=exctype is None)
 
 
 # Alias some common exceptions
@@ -25,6 +25,12 @@ class lazy_property(property):
 
 		return result
 
+	def prime(self, instance, value):
+		"""
+			Stores value as the cached result without calling fget or fset
+		"""
+		setattr(instance, self._name, value)
+
 	def __set__(self, instance, value):
 		if instance is None:
 			raise AttributeError
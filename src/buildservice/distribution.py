@@ -32,8 +32,12 @@ class Distributions(base.Object):
 		return iter(distros)
 
 	def get_by_id(self, distro_id):
-		return self._get_distribution("SELECT * FROM distributions \
-			WHERE id = %s", distro_id)
+		distro = self.backend.objects.get(Distribution, distro_id)
+		if distro is None:
+			distro = self._get_distribution("SELECT * FROM distributions \
+				WHERE id = %s", distro_id)
+
+		return distro
 
 	def get_by_name(self, sname):
 		return self._get_distribution("SELECT * FROM distributions \
@@ -0,0 +1,187 @@
+#!/usr/bin/python
+
+import json
+import logging
+import os
+
+import pakfire
+import pakfire.packages
+import pakfire.repository
+
+from . import base
+
+log = logging.getLogger("indexer")
+log.propagate = 1
+
+class Indexer(base.Object):
+	"""
+		Writes the index of a repository
+
+		Everything that goes into the index is read from each package
+		file only once and then kept in the database by the hash of the
+		file. Writing an index therefore only needs to open the packages
+		that have never been indexed before.
+	"""
+	# The attributes of a package that are put into the index
+	attributes = (
+		"name",
+		"epoch",
+		"version",
+		"release",
+		"arch",
+		"uuid",
+		"hash1",
+		"vendor",
+		"maintainer",
+		"groups",
+		"summary",
+		"description",
+		"license",
+		"url",
+		"build_host",
+		"build_id",
+		"build_time",
+		"size",
+		"inst_size",
+		"requires",
+		"prerequires",
+		"provides",
+		"conflicts",
+		"obsoletes",
+		"recommends",
+		"suggests",
+		"filelist",
+	)
+
+	def get_metadata(self, path, packages):
+		"""
+			Returns a dictionary with the index metadata of all given
+			packages by their hash. Packages that are not known, yet,
+			are read from path.
+		"""
+		res = self.db.query("SELECT hash_sha512, metadata FROM packages_index_cache \
+			WHERE hash_sha512 = ANY(%s)", [p.hash_sha512 for p in packages])
+
+		metadata = dict((row.hash_sha512, json.loads(row.metadata)) for row in res)
+
+		missing = []
+		for p in packages:
+			# Read the package again if the cache is incomplete
+			if all(attr in metadata.get(p.hash_sha512, {}) for attr in self.attributes):
+				continue
+
+			log.debug("Reading %s..." % p.filename)
+
+			metadata[p.hash_sha512] = self._read_metadata(os.path.join(path, p.filename))
+			missing.append(p.hash_sha512)
+
+		if missing:
+			self.db.execute_values("INSERT INTO packages_index_cache(hash_sha512, metadata) \
+				VALUES %s ON CONFLICT (hash_sha512) DO UPDATE SET metadata = excluded.metadata",
+				[(hash, json.dumps(metadata[hash])) for hash in missing])
+
+		log.debug("Read %s of %s package(s)" % (len(missing), len(packages)))
+
+		return metadata
+
+	def _read_metadata(self, path):
+		pkg = pakfire.packages.open(None, None, path)
+
+		metadata = {}
+
+		for attr in self.attributes:
+			val = getattr(pkg, attr, None)
+
+			if attr == "filelist":
+				val = [getattr(f, "name", f) for f in val or []]
+
+			elif isinstance(val, (list, tuple)):
+				val = list(val)
+
+			metadata[attr] = val
+
+		return metadata
+
+	def write(self, path, arch, packages, name, key_id=None):
+		"""
+			Writes the index of all packages to the repository in path
+		"""
+		metadata = self.get_metadata(path, packages)
+
+		entries = [(p.filename, metadata[p.hash_sha512]) for p in packages]
+
+		self._write(path, arch, entries, name, key_id=key_id)
+
+	def _write(self, path, arch, entries, name, key_id=None):
+		p = pakfire.PakfireServer(arch=arch)
+
+		repo = pakfire.repository.RepositoryDir(p, name=name,
+			description="New repository.", path=path, key_id=key_id)
+
+		for filename, metadata in sorted(entries):
+			repo.index.add_package(IndexEntry(p, repo, filename, metadata))
+
+		repo.save()
+
+
+def _metadata_property(attr):
+	def get(self):
+		return self._convert(self._metadata.get(attr))
+
+	return property(get)
+
+
+class IndexEntry(pakfire.packages.Package):
+	"""
+		A package that is made from cached metadata instead of
+		reading the package file
+	"""
+	def __init__(self, pakfire, repo, filename, metadata):
+		super(IndexEntry, self).__init__(pakfire, repo)
+
+		self._filename = filename
+		self._metadata = metadata
+
+	@property
+	def filename(self):
+		return self._filename
+
+	name = _metadata_property("name")
+	epoch = _metadata_property("epoch")
+	version = _metadata_property("version")
+	release = _metadata_property("release")
+	arch = _metadata_property("arch")
+	uuid = _metadata_property("uuid")
+	hash1 = _metadata_property("hash1")
+	vendor = _metadata_property("vendor")
+	maintainer = _metadata_property("maintainer")
+	groups = _metadata_property("groups")
+	summary = _metadata_property("summary")
+	description = _metadata_property("description")
+	license = _metadata_property("license")
+	url = _metadata_property("url")
+	build_host = _metadata_property("build_host")
+	build_id = _metadata_property("build_id")
+	build_time = _metadata_property("build_time")
+	size = _metadata_property("size")
+	inst_size = _metadata_property("inst_size")
+	requires = _metadata_property("requires")
+	prerequires = _metadata_property("prerequires")
+	provides = _metadata_property("provides")
+	conflicts = _metadata_property("conflicts")
+	obsoletes = _metadata_property("obsoletes")
+	recommends = _metadata_property("recommends")
+	suggests = _metadata_property("suggests")
+	filelist = _metadata_property("filelist")
+
+	@classmethod
+	def _convert(cls, val):
+		# Pakfire expects byte strings
+		if isinstance(val, unicode):
+			return val.encode("utf-8")
+
+		# Return a copy so that pakfire may change it
+		if isinstance(val, list):
+			return [cls._convert(v) for v in val]
+
+		return val
@@ -11,9 +11,12 @@ log.propagate = 1
 PENDING_STATE = "pending"
 
 class JobQueue(base.Object):
+	# The order in which jobs are taken from the queue
+	order = "queue.test DESC, queue.priority DESC, queue.time_created"
+
 	def __iter__(self):
 		jobs = self.backend.jobs._get_jobs("SELECT jobs.* FROM jobs_queue queue \
-			LEFT JOIN jobs ON queue.job_id = jobs.id")
+			LEFT JOIN jobs ON queue.job_id = jobs.id ORDER BY %s" % self.order)
 
 		return iter(jobs)
 
@@ -25,14 +28,13 @@ class JobQueue(base.Object):
 	def for_arches(self, arches, limit=None):
 		jobs = self.backend.jobs._get_jobs("SELECT jobs.* FROM jobs_queue queue \
 			LEFT JOIN jobs ON queue.job_id = jobs.id \
-				WHERE jobs.arch = ANY(%s) LIMIT %s", arches, limit)
+				WHERE queue.arch = ANY(%%s) ORDER BY %s LIMIT %%s" % self.order, arches, limit)
 
 		return jobs
 
 	def get_length_for_arch(self, arch):
-		res = self.db.get("SELECT COUNT(*) AS len FROM jobs_queue queue \
-			LEFT JOIN jobs on queue.job_id = jobs.id \
-				WHERE jobs.arch = %s", arch)
+		res = self.db.get("SELECT COUNT(*) AS len FROM jobs_queue \
+			WHERE arch = %s", arch)
 
 		return res.len
 
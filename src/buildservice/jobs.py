@@ -4,7 +4,6 @@ import datetime
 import hashlib
 import logging
 import os
-import shutil
 import uuid
 
 import pakfire
@@ -28,11 +27,18 @@ class Jobs(base.Object):
 		if res:
 			return Job(self.backend, res.id, data=res)
 
-	def _get_jobs(self, query, *args):
+	def _get_jobs(self, query, *args, **kwargs):
+		prefetch = kwargs.pop("prefetch", None)
+
 		res = self.db.query(query, *args)
 
-		for row in res:
-			yield Job(self.backend, row.id, data=row)
+		jobs = [Job(self.backend, row.id, data=row) for row in res]
+
+		# Load all related objects at once
+		if prefetch:
+			self.prefetch(jobs, prefetch)
+
+		return iter(jobs)
 
 	def create(self, build, arch, test=False, superseeds=None):
 		job = self._get_job("INSERT INTO jobs(uuid, build_id, arch, test) \
@@ -49,7 +55,97 @@ class Jobs(base.Object):
 		return job
 
 	def get_by_id(self, id):
-		return self._get_job("SELECT * FROM jobs WHERE id = %s", id)
+		job = self.backend.objects.get(Job, id)
+		if job is None:
+			job = self._get_job("SELECT * FROM jobs WHERE id = %s", id)
+
+		return job
+
+	def get_by_ids(self, ids, prefetch=None):
+		"""
+			Fetches all jobs with the given IDs in one query and
+			returns them in the same order
+		"""
+		return self._get_by_ids(self._get_jobs, "jobs", ids, prefetch=prefetch)
+
+	def prefetch(self, jobs, prefetch):
+		"""
+			Loads the given relations ("build", "builder" and anything
+			below "build." like "build.pkg") of all jobs with one query
+			per relation and stores them in the lazy properties
+		"""
+		jobs = list(jobs)
+		if not jobs:
+			return jobs
+
+		for relation, nested in base.split_prefetch(prefetch).items():
+			if relation == "build":
+				builds = self.backend.builds.get_by_ids(
+					list(set(j.data.build_id for j in jobs)), prefetch=nested)
+				builds = dict((b.id, b) for b in builds)
+
+				for job in jobs:
+					Job.build.prime(job, builds.get(job.data.build_id))
+
+			elif relation == "builder":
+				builders = self.backend.builders.get_by_ids(
+					list(set(j.data.builder_id for j in jobs if j.data.builder_id)))
+				builders = dict((b.id, b) for b in builders)
+
+				for job in jobs:
+					Job.builder.prime(job, builders.get(job.data.builder_id))
+
+			else:
+				raise ValueError("Cannot prefetch %s of jobs" % relation)
+
+		return jobs
+
+	def claim_many(self, builder, ids):
+		"""
+			Hands the jobs with the given IDs over to builder and returns them.
+
+			The jobs are selected and marked as dispatching in one statement.
+			Jobs that are being claimed by someone else at the same time are
+			skipped, so that no job is ever given to more than one builder.
+
+			The builder is locked until the end of the transaction and never
+			gets more jobs than it has free slots for.
+		"""
+		with self.db.transaction():
+			builder.lock()
+
+			limit = min(len(ids), builder.free_slots)
+			if limit <= 0:
+				return []
+
+			return self._claim_many(builder, ids, limit=limit)
+
+	def _claim_many(self, builder, ids, limit):
+		# Only jobs that are still in the queue can be claimed and the
+		# queue is locked so that nobody else can claim the same job
+		query = "SELECT queue.job_id FROM jobs_queue queue \
+			JOIN jobs ON queue.job_id = jobs.id \
+			WHERE queue.job_id = ANY(%s) AND jobs.state = 'pending' \
+				AND jobs.dependency_check_succeeded IS TRUE \
+			ORDER BY array_position(%s, queue.job_id) LIMIT %s \
+			FOR UPDATE OF queue SKIP LOCKED"
+
+		jobs = self._get_jobs("UPDATE jobs SET state = %%s, builder_id = %%s \
+			WHERE id IN (%s) RETURNING *" % query, "dispatching", builder.id, ids, ids, limit)
+		jobs = list(jobs)
+
+		for job in jobs:
+			log.info("Builder %s has been assigned to %s" % (builder.name, job.name))
+
+			# Automatically update the state of the build (not on test builds)
+			if not job.test:
+				job.build.auto_update_state()
+
+		# Keep the order of the given IDs
+		positions = dict((id, i) for i, id in enumerate(ids))
+		jobs.sort(key=lambda j: positions[j.id])
+
+		return jobs
 
 	def get_by_uuid(self, uuid):
 		return self._get_job("SELECT * FROM jobs WHERE uuid = %s", uuid)
@@ -171,7 +267,13 @@ class Job(base.DataObject):
 		if not self.state == "pending":
 			return
 
-		res = self.db.get("SELECT rank FROM jobs_queue WHERE job_id = %s", self.id)
+		# Count all jobs that are ahead of this one
+		res = self.db.get("SELECT ( \
+				SELECT COUNT(*) FROM jobs_queue queue WHERE \
+					queue.test > job.test OR (queue.test = job.test AND ( \
+						queue.priority > job.priority OR (queue.priority = job.priority \
+							AND queue.time_created < job.time_created))) \
+			) + 1 AS rank FROM jobs_queue job WHERE job.job_id = %s", self.id)
 
 		if res:
 			return res.rank
@@ -191,15 +293,6 @@ class Job(base.DataObject):
 
 	superseeded_by = lazy_property(get_superseeded_by, set_superseeded_by)
 
-	def start(self, builder):
-		"""
-			Starts this job on builder
-		"""
-		self.builder = builder
-
-		# Start to dispatch the build job
-		self.state = "dispatching"
-
 	def running(self):
 		self.state = "running"
 
@@ -254,7 +347,8 @@ class Job(base.DataObject):
 
 		# Remove all logfiles
 		for logfile in self.logfiles:
-			self.backend.delete_file(os.path.join(PACKAGES_DIR, logfile.path))
+			self.backend.delete_file(os.path.join(PACKAGES_DIR, logfile.path),
+				hash=logfile.data.hash_sha512)
 
 		self.db.execute("DELETE FROM logfiles WHERE job_id = %s", self.id)
 
@@ -351,30 +445,6 @@ class Job(base.DataObject):
 
 	builder = lazy_property(get_builder, set_builder)
 
-	@property
-	def candidate_builders(self):
-		"""
-			Returns all active builders that could build this job
-		"""
-		builders = self.backend.builders.get_for_arch(self.arch)
-
-		# Remove all builders that are not available
-		builders = (b for b in builders if b.enabled and b.is_online())
-
-		# Remove all builders that have too many jobs
-		builders = (b for b in builders if not b.too_many_jobs)
-
-		# Sort them by the fastest builder first
-		return sorted(builders, key=lambda b: -b.performance_index)
-
-	@property
-	def designated_builder(self):
-		"""
-			Returns the fastest candidate builder builder
-		"""
-		if self.candidate_builders:
-			return self.candidate_builders[0]
-
 	@property
 	def arch(self):
 		return self.data.arch
@@ -485,13 +555,16 @@ class Job(base.DataObject):
 			h.update(buf)
 		f.close()
 
-		# Copy the file to the final location.
-		shutil.copy2(filename, target_filename)
+		hash = h.hexdigest()
+
+		# Put the file into the storage and link it to the final location.
+		self.backend.storage.add(filename, hash=hash)
+		self.backend.storage.link(hash, target_filename, path=filename)
 
 		# Create an entry in the database.
 		self.db.execute("INSERT INTO logfiles(job_id, path, filesize, hash_sha512) \
 			VALUES(%s, %s, %s, %s)", self.id, os.path.relpath(target_filename, PACKAGES_DIR),
-			os.path.getsize(target_filename), h.hexdigest())
+			os.path.getsize(target_filename), hash)
 
 	def _add_file_package(self, filename):
 		# Open package (creates entry in the database)
@@ -550,10 +623,12 @@ class Job(base.DataObject):
 		rows = self.db.query("SELECT * FROM jobs_buildroots \
 			WHERE jobs_buildroots.job_id = %s ORDER BY pkg_name", self.id)
 
+		# Search for all packages in the packages table at once
+		packages = self.backend.packages.get_by_uuids([row.pkg_uuid for row in rows])
+
 		pkgs = []
 		for row in rows:
-			# Search for this package in the packages table.
-			pkg = self.backend.packages.get_by_uuid(row.pkg_uuid)
+			pkg = packages.get(row.pkg_uuid)
 			pkgs.append((row.pkg_name, row.pkg_uuid, pkg))
 
 		return pkgs
@@ -53,7 +53,11 @@ class Mirrors(base.Object):
 		return mirror
 
 	def get_by_id(self, id):
-		return self._get_mirror("SELECT * FROM mirrors WHERE id = %s", id)
+		mirror = self.backend.objects.get(Mirror, id)
+		if mirror is None:
+			mirror = self._get_mirror("SELECT * FROM mirrors WHERE id = %s", id)
+
+		return mirror
 
 	def get_by_hostname(self, hostname):
 		return self._get_mirror("SELECT * FROM mirrors \
@@ -3,7 +3,6 @@
 import datetime
 import logging
 import os
-import shutil
 
 import pakfire
 import pakfire.packages as packages
@@ -31,9 +30,20 @@ class Packages(base.Object):
 		for row in res:
 			yield Package(self.backend, row.id, data=row)
 
+	def _iterate_packages(self, query, *args):
+		"""
+			Like _get_packages() but streams the rows from the database
+		"""
+		for row in self.db.iterate(query, *args):
+			yield Package(self.backend, row.id, data=row)
+
 	def get_by_id(self, pkg_id):
-		return self._get_package("SELECT * FROM packages \
-			WHERE id = %s", pkg_id)
+		pkg = self.backend.objects.get(Package, pkg_id)
+		if pkg is None:
+			pkg = self._get_package("SELECT * FROM packages \
+				WHERE id = %s", pkg_id)
+
+		return pkg
 
 	def get_list(self):
 		"""
@@ -51,6 +61,26 @@ class Packages(base.Object):
 
 		return Package(self.backend, pkg.id, pkg)
 
+	def get_by_ids(self, ids):
+		"""
+			Fetches all packages with the given IDs in one query and
+			returns them in the same order
+		"""
+		return self._get_by_ids(self._get_packages, "packages", ids)
+
+	def get_by_uuids(self, uuids):
+		"""
+			Fetches all packages with the given UUIDs in one query and
+			returns a dictionary that maps each found UUID to its package
+		"""
+		if not uuids:
+			return {}
+
+		pkgs = self._get_packages("SELECT DISTINCT ON (uuid) * FROM packages \
+			WHERE uuid = ANY(%s)", list(uuids))
+
+		return dict((p.uuid, p) for p in pkgs)
+
 	def create(self, path):
 		# Just check if the file really exist
 		assert os.path.exists(path)
@@ -104,25 +134,16 @@ class Packages(base.Object):
 		pkg = self._get_package(_query, *vals)
 
 		# Dependency information.
-		for d in _pkg.prerequires:
-			pkg.add_dependency("prerequires", d)
-
-		for d in _pkg.requires:
-			pkg.add_dependency("requires", d)
-
-		for d in _pkg.provides:
-			pkg.add_dependency("provides", d)
-
-		for d in _pkg.conflicts:
-			pkg.add_dependency("conflicts", d)
+		deps = []
+		for type in ("prerequires", "requires", "provides", "conflicts", "obsoletes"):
+			for d in getattr(_pkg, type):
+				deps.append((type, d))
 
-		for d in _pkg.obsoletes:
-			pkg.add_dependency("obsoletes", d)
+		pkg.add_dependencies(deps)
 
 		# Add all files to filelists table
-		for f in _pkg.filelist:
-			pkg.add_file(f.name, f.size, f.hash1, f.type, f.config, f.mode,
-				f.user, f.group, f.mtime, f.capabilities)
+		pkg.add_files((f.name, f.size, f.hash1, f.type, f.config, f.mode,
+			f.user, f.group, f.mtime, f.capabilities) for f in _pkg.filelist)
 
 		# Return the newly created object
 		return pkg
@@ -181,13 +202,19 @@ class Package(base.DataObject):
 			return pakfire.util.version_compare(self.backend, self.friendly_name, other.friendly_name) < 0
 
 	def delete(self):
-		self.backend.delete_file(os.path.join(PACKAGES_DIR, self.path))
+		self.backend.delete_file(os.path.join(PACKAGES_DIR, self.path),
+			hash=self.hash_sha512)
 
 		self.db.execute("DELETE FROM packages_deps WHERE pkg_id = %s", self.id)
 
 		# Delete all files from the filelist.
 		self.db.execute("DELETE FROM filelists WHERE pkg_id = %s", self.id)
 
+		# Forget the index metadata unless another package has the same file
+		self.db.execute("DELETE FROM packages_index_cache WHERE hash_sha512 = %s \
+			AND NOT EXISTS (SELECT 1 FROM packages WHERE hash_sha512 = %s AND id <> %s)",
+			self.hash_sha512, self.hash_sha512, self.id)
+
 		# Delete the package.
 		self.db.execute("DELETE FROM packages WHERE id = %s", self.id)
 
@@ -265,10 +292,23 @@ class Package(base.DataObject):
 		return self.data.size
 
 	def add_dependency(self, type, what):
-		self.db.execute("INSERT INTO packages_deps(pkg_id, type, what) \
-			VALUES(%s, %s, %s)", self.id, type, what)
+		self.add_dependencies([(type, what)])
+
+	def add_dependencies(self, deps):
+		"""
+			Adds a list of (type, what) tuples in as few statements as possible
+		"""
+		deps = list(deps)
+		if not deps:
+			return
 
-		self.deps.append((type, what))
+		# Load the existing dependencies before adding any new ones
+		cache = self.deps
+
+		self.db.execute_values("INSERT INTO packages_deps(pkg_id, type, what) VALUES %s",
+			[(self.id, type, what) for type, what in deps])
+
+		cache.extend(deps)
 
 	def has_deps(self):
 		"""
@@ -372,7 +412,9 @@ class Package(base.DataObject):
 
 		log.debug("Copying %s to %s" % (src, dst))
 
-		shutil.copy2(src, dst)
+		# Link the file from the storage instead of copying it
+		hash = self.backend.storage.add(src, hash=self.hash_sha512)
+		self.backend.storage.link(hash, dst, path=src)
 
 	def move(self, target_dir):
 		# Create directory if it does not exist, yet.
@@ -382,8 +424,16 @@ class Package(base.DataObject):
 		# Make full path where to put the file.
 		target = os.path.join(target_dir, os.path.basename(self.path))
 
-		# Copy the file to the target directory (keeping metadata).
-		shutil.move(self.path, target)
+		# Put the file into the storage and link it to the target directory.
+		# Nothing to do if the file is already in place
+		if os.path.abspath(self.path) == os.path.abspath(target):
+			return
+
+		# Put the file into the storage and link it to the target directory.
+		hash = self.backend.storage.add(self.path, hash=self.hash_sha512)
+		self.backend.storage.link(hash, target, path=self.path)
+
+		os.unlink(self.path)
 
 		# Update file path in the database.
 		self._set_attribute("path", os.path.relpath(target, PACKAGES_DIR))
@@ -422,12 +472,28 @@ class Package(base.DataObject):
 			return File(self.backend, res)
 
 	def add_file(self, name, size, hash_sha512, type, config, mode, user, group, mtime, capabilities):
-		# Convert mtime from seconds since epoch to datetime
-		mtime = datetime.datetime.utcfromtimestamp(float(mtime))
+		self.add_files([(name, size, hash_sha512, type, config, mode,
+			user, group, mtime, capabilities)])
+
+	def add_files(self, files):
+		"""
+			Adds many files at once
+
+			Each file is a tuple with the same arguments that add_file() takes.
+		"""
+		rows = []
+		for name, size, hash_sha512, type, config, mode, user, group, mtime, capabilities in files:
+			# Convert mtime from seconds since epoch to datetime
+			mtime = datetime.datetime.utcfromtimestamp(float(mtime))
+
+			rows.append((self.id, name, size, hash_sha512, type, config, mode,
+				user, group, mtime, capabilities))
+
+		if not rows:
+			return
 
-		self.db.execute("INSERT INTO filelists(pkg_id, name, size, hash_sha512, type, config, mode, \
-			\"user\", \"group\", mtime, capabilities) VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-			self.id, name, size, hash_sha512, type, config, mode, user, group, mtime, capabilities)
+		self.db.execute_values("INSERT INTO filelists(pkg_id, name, size, hash_sha512, type, config, mode, \
+			\"user\", \"group\", mtime, capabilities) VALUES %s", rows)
 
 	def open(self):
 		path = os.path.join(PACKAGES_DIR, self.path)
@@ -1,7 +1,9 @@
 #!/usr/bin/python
 
 import logging
+import multiprocessing
 import os.path
+import time
 
 import pakfire
 
@@ -38,8 +40,12 @@ class Repositories(base.Object):
 			VALUES(%s, %s, %s) RETURNING *", distro.id, name, description)
 
 	def get_by_id(self, repo_id):
-		return self._get_repository("SELECT * FROM repositories \
-			WHERE id = %s", repo_id)
+		repo = self.backend.objects.get(Repository, repo_id)
+		if repo is None:
+			repo = self._get_repository("SELECT * FROM repositories \
+				WHERE id = %s", repo_id)
+
+		return repo
 
 	def get_history(self, limit=None, offset=None, build=None, repo=None, user=None):
 		query = "SELECT * FROM repositories_history"
@@ -62,25 +68,72 @@ class Repositories(base.Object):
 
 		return entries
 
-	def remaster(self):
+	def remaster(self, processes=None):
 		"""
 			Remasters all repositories
+
+			All architectures of all repositories are processed at the
+			same time in a pool of worker processes.
 		"""
+		# Start the workers before this process uses the database. The
+		# connection pool is only opened when the first query is run,
+		# so the workers don't inherit any connections and each of
+		# them opens its own.
+		pool = multiprocessing.Pool(processes,
+			initializer=_init_worker, initargs=(self.backend.config_file,))
+
+		try:
+			self._remaster(pool)
+		finally:
+			pool.close()
+			pool.join()
+
+	def _remaster(self, pool):
+		repos = {}
+
 		for repo in self:
 			# Skip all repositories that don't need an update
 			if not repo.needs_update:
 				log.debug("Repository %s does not need an update" % repo)
 				continue
 
-			with self.db.transaction():
-				repo.remaster()
+			repos[repo.id] = repo
+
+		if not repos:
+			return
+
+		# Builds that are added while we are running will be picked up next time
+		started_at = self.db.get("SELECT NOW() AS now").now
+
+		tasks = [(repo.id, arch, repo.update_forced)
+			for repo in repos.values() for arch in repo.arches]
+
+		failed = set()
+
+		for repo_id, arch, changed, runtime in pool.imap_unordered(_remaster_arch, tasks):
+			repo = repos[repo_id]
+
+			if changed is None:
+				log.error("Could not remaster %s (%s) after %.2fs" % (repo.name, arch, runtime))
+				failed.add(repo_id)
+
+			elif changed:
+				log.info("Remastered %s (%s) in %.2fs" % (repo.name, arch, runtime))
+
+			else:
+				log.debug("%s (%s) was unchanged (%.2fs)" % (repo.name, arch, runtime))
+
+		with self.db.transaction():
+			for repo in repos.values():
+				if not repo.id in failed:
+					repo.updated(started_at)
 
 	def cleanup(self):
 		"""
 			Cleans up all repositories
 		"""
 		for repo in self:
-			with self.db.transaction():
+			with self.backend.objects.scope(), self.db.transaction():
 				repo.cleanup()
 
 
@@ -96,7 +149,7 @@ class Repository(base.DataObject):
 			return self.parent_id == other.id
 
 	def __iter__(self):
-		builds = self.backend.builds._get_builds("SELECT builds.* FROM repositories_builds \
+		builds = self.backend.builds._iterate_builds("SELECT builds.* FROM repositories_builds \
 			LEFT JOIN builds ON repositories_builds.build_id = builds.id \
 			WHERE repositories_builds.repo_id = %s", self.id)
 
@@ -323,12 +376,12 @@ class Repository(base.DataObject):
 				query += " LIMIT %s"
 				args  += [limit,]
 
-		_builds = []
-		for build in self.db.query(query, *args):
-			build = self.pakfire.builds.get_by_id(build.id)
-			build._repo = self
+		# Fetch all builds at once
+		ids = [row.id for row in self.db.query(query, *args)]
+		_builds = self.backend.builds.get_by_ids(ids)
 
-			_builds.append(build)
+		for build in _builds:
+			build._repo = self
 
 		return _builds
 
@@ -345,12 +398,12 @@ class Repository(base.DataObject):
 
 	def get_packages(self, arch):
 		if arch == "src":
-			return self.backend.packages._get_packages("SELECT packages.* FROM repositories_builds \
+			return self.backend.packages._iterate_packages("SELECT packages.* FROM repositories_builds \
 				LEFT JOIN builds ON repositories_builds.build_id = builds.id \
 				LEFT JOIN packages ON builds.pkg_id = packages.id \
 				WHERE repositories_builds.repo_id = %s", self.id)
 
-		return self.backend.packages._get_packages("SELECT packages.* FROM repositories_builds \
+		return self.backend.packages._iterate_packages("SELECT packages.* FROM repositories_builds \
 				LEFT JOIN builds ON repositories_builds.build_id = builds.id \
 				LEFT JOIN jobs ON builds.id = jobs.build_id \
 				LEFT JOIN jobs_packages ON jobs.id = jobs_packages.job_id \
@@ -362,25 +415,33 @@ class Repository(base.DataObject):
 
 	@property
 	def unpushed_builds(self):
-		return self.backend.builds._get_builds("SELECT builds.* FROM repositories \
+		builds = self.backend.builds._get_builds("SELECT builds.* FROM repositories \
 			LEFT JOIN repositories_builds ON repositories.id = repositories_builds.repo_id \
 			LEFT JOIN builds ON repositories_builds.build_id = builds.id \
 			WHERE repositories.id = %s \
 				AND repositories_builds.time_added >= repositories.last_update", self.id)
 
+		return list(builds)
+
 	def get_obsolete_builds(self):
 		return self.pakfire.builds.get_obsolete(self)
 
 	@property
 	def needs_update(self):
-		if self.unpushed_builds:
+		if self.update_forced:
 			return True
 
-		return False
+		res = self.db.get("SELECT EXISTS(SELECT 1 FROM repositories_builds \
+			LEFT JOIN repositories ON repositories_builds.repo_id = repositories.id \
+			WHERE repositories.id = %s AND (repositories.last_update IS NULL \
+				OR repositories_builds.time_added >= repositories.last_update)) AS needs_update",
+			self.id)
+
+		return res.needs_update
 
-	def updated(self):
-		self.db.execute("UPDATE repositories SET last_update = NOW() \
-			WHERE id = %s", self.id)
+	def updated(self, time=None):
+		self.db.execute("UPDATE repositories SET last_update = COALESCE(%s, NOW()) \
+			WHERE id = %s", time, self.id)
 
 		# Reset forced update flag
 		self.update_forced = False
@@ -389,50 +450,106 @@ class Repository(base.DataObject):
 		log.info("Going to update repository %s..." % self.name)
 
 		for arch in self.arches:
-			changed = False
+			self.remaster_arch(arch, force=self.update_forced)
 
-			repo_path = os.path.join(self.path, arch)
-			log.debug("  Path: %s" % repo_path)
+		# Update the timestamp when we started at last
+		self.updated()
 
-			if not os.path.exists(repo_path):
-				os.makedirs(repo_path)
+	def get_index(self, arch):
+		"""
+			Returns the filenames and hashes of all packages
+			that are in the current index of the given architecture
+		"""
+		res = self.db.query("SELECT filename, hash_sha512 FROM repositories_indexes \
+			WHERE repo_id = %s AND arch = %s", self.id, arch)
 
-			# Get all packages that are to be included in this repository
-			packages = []
-			for p in self.get_packages(arch):
-				path = os.path.join(repo_path, p.filename)
-				packages.append(path)
+		return dict((row.filename, row.hash_sha512) for row in res)
 
-				# Nothing to do if the package already exists
-				if os.path.exists(path):
-					continue
+	def set_index(self, arch, added, removed):
+		"""
+			Updates the packages in the index of the given architecture
+		"""
+		with self.db.transaction():
+			if removed:
+				self.db.execute("DELETE FROM repositories_indexes \
+					WHERE repo_id = %s AND arch = %s AND filename = ANY(%s)",
+					self.id, arch, removed)
+
+			if added:
+				self.db.execute_values("INSERT INTO repositories_indexes(repo_id, arch, \
+					filename, hash_sha512) VALUES %s ON CONFLICT (repo_id, arch, filename) \
+					DO UPDATE SET hash_sha512 = excluded.hash_sha512",
+					[(self.id, arch, filename, hash) for filename, hash in added.items()])
+
+	def remaster_arch(self, arch, force=False):
+		"""
+			Updates the repository for the given architecture and
+			returns True if the index has been regenerated.
+		"""
+		repo_path = os.path.join(self.path, arch)
+		log.debug("  Path: %s" % repo_path)
 
-				# Copy the package into the repository
-				log.info("Adding %s..." % p)
-				p.copy(repo_path)
+		if not os.path.exists(repo_path):
+			os.makedirs(repo_path)
 
-				# XXX need to sign the new package here
+		changed = False
 
-				# The repository has been changed
-				changed = True
+		# Get all packages that are to be included in this repository
+		packages = []
+		for p in self.get_packages(arch):
+			path = os.path.join(repo_path, p.filename)
+			packages.append(p)
 
-			# No need to regenerate the index if the repository hasn't changed
-			if not changed and not self.update_forced:
+			# Nothing to do if the package already exists
+			if os.path.exists(path):
 				continue
 
-			# Find the key to sign the package.
-			key_id = None
-			if self.key:
-				key_id = self.key.fingerprint
+			# Copy the package into the repository
+			log.info("Adding %s..." % p)
+			p.copy(repo_path)
 
-			# Create package index.
-			p = pakfire.PakfireServer(arch=arch)
-			p.repo_create(repo_path, packages,
-				name="%s - %s.%s" % (self.distro.name, self.name, arch),
-				key_id=key_id)
+			# XXX need to sign the new package here
 
-		# Update the timestamp when we started at last
-		self.updated()
+			# The repository has been changed
+			changed = True
+
+		# Compare with what is in the current index
+		index = self.get_index(arch)
+
+		added = dict((p.filename, p.hash_sha512) for p in packages
+			if not index.get(p.filename) == p.hash_sha512)
+		filenames = set(p.filename for p in packages)
+		removed = [filename for filename in index if not filename in filenames]
+
+		# No need to regenerate the index if the repository hasn't changed
+		if not changed and not added and not removed and not force:
+			return False
+
+		log.debug("  %s package(s) added, %s removed" % (len(added), len(removed)))
+
+		# Find the key to sign the package.
+		key_id = None
+		if self.key:
+			key_id = self.key.fingerprint
+
+		name = "%s - %s.%s" % (self.distro.name, self.name, arch)
+
+		# Create package index from cached metadata
+		try:
+			self.backend.indexer.write(repo_path, arch, packages, name=name, key_id=key_id)
+
+		# Read all packages if this version of pakfire cannot use the cached metadata
+		except (AttributeError, TypeError, NotImplementedError) as e:
+			log.error("Could not write index of %s, reading all packages: %s" % (name, e))
+
+			server = pakfire.PakfireServer(arch=arch)
+			server.repo_create(repo_path, [os.path.join(repo_path, f) for f in sorted(filenames)],
+				name=name, key_id=key_id)
+
+		# Remember what is in the index now
+		self.set_index(arch, added, removed)
+
+		return True
 
 	def cleanup(self):
 		log.info("Cleaning up repository %s..." % self.name)
@@ -515,3 +632,43 @@ class RepositoryAux(base.DataObject):
 		]
 
 		return "\n".join(lines)
+
+
+# The backend of each remaster worker process
+_backend = None
+
+def _init_worker(config_file):
+	global _backend
+
+	from . import Backend
+
+	# The pool would start new workers forever if this raised
+	try:
+		_backend = Backend(config_file)
+	except Exception:
+		log.exception("Could not start remaster worker")
+
+def _remaster_arch(task):
+	"""
+		Remasters one architecture of a repository in a worker process
+
+		Returns the ID of the repository, the architecture, whether the
+		index has been regenerated (None on error) and the time it took.
+	"""
+	repo_id, arch, force = task
+
+	t = time.time()
+
+	if _backend is None:
+		return repo_id, arch, None, 0
+
+	try:
+		with _backend.objects.scope():
+			repo = _backend.repos.get_by_id(repo_id)
+			changed = repo.remaster_arch(arch, force=force)
+
+	except Exception:
+		log.exception("Could not remaster repository %s (%s)" % (repo_id, arch))
+		changed = None
+
+	return repo_id, arch, changed, time.time() - t
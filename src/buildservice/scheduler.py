@@ -0,0 +1,201 @@
+#!/usr/bin/python
+
+import logging
+import threading
+import time
+
+from . import base
+
+log = logging.getLogger("scheduler")
+log.propagate = 1
+
+class Scheduler(base.Object):
+	"""
+		Estimates how long jobs will take and how fast builders are
+		from the history of finished builds and decides which builder
+		should build the long jobs in the queue.
+
+		Long jobs are handed out longest first to the builder that will
+		be done with them the earliest (LPT scheduling) so that a large
+		rebuild does not end waiting for one big package on a slow builder.
+	"""
+	# Jobs that are expected to take longer than this (in seconds)
+	# are reserved for a builder
+	long_job_threshold = 1800
+
+	# Which builds are considered to estimate durations
+	history = "90 days"
+	history_length = 5
+
+	# Estimate for jobs that have never been built before
+	default_duration = 600
+
+	# Speeds of builders are recalculated after this many seconds
+	speeds_lifetime = 600
+
+	def init(self):
+		self._speeds = {}
+		self._speeds_expire_at = 0
+		self._speeds_lock = threading.Lock()
+
+	def get_speed(self, builder):
+		"""
+			Returns how fast builder is compared to the average builder
+			(builders without any history are considered average)
+		"""
+		with self._speeds_lock:
+			if self._speeds_expire_at < time.time():
+				self._speeds = self._load_speeds()
+				self._speeds_expire_at = time.time() + self.speeds_lifetime
+
+			return self._speeds.get(builder.id, 1.0)
+
+	def _load_speeds(self):
+		"""
+			Compares every build of every builder to the average duration
+			of the same package on the same architecture on all builders
+		"""
+		res = self.db.query("WITH durations AS ( \
+				SELECT builds_times.builder_id, \
+					builds_times.duration / AVG(builds_times.duration) OVER ( \
+						PARTITION BY packages.name, builds_times.arch) AS ratio \
+				FROM builds_times \
+					JOIN builds ON builds_times.build_id = builds.id \
+					JOIN packages ON builds.pkg_id = packages.id \
+				WHERE builds_times.builder_id IS NOT NULL \
+					AND builds_times.duration > 0 \
+					AND builds_times.time_finished >= NOW() - %s::interval \
+			) \
+			SELECT builder_id, EXP(AVG(LN(ratio))) AS factor FROM durations \
+				WHERE ratio > 0 GROUP BY builder_id", self.history)
+
+		return dict((row.builder_id, 1.0 / row.factor) for row in res if row.factor)
+
+	def _estimate(self, condition, *args):
+		"""
+			Returns the expected durations (in seconds) of all jobs
+			that match condition
+		"""
+		# Average the last builds of every package and architecture at once
+		res = self.db.query("WITH selected AS ( \
+				SELECT jobs.id, jobs.arch, packages.name FROM jobs \
+					JOIN builds ON jobs.build_id = builds.id \
+					JOIN packages ON builds.pkg_id = packages.id \
+				WHERE %s \
+			), \
+			history AS ( \
+				SELECT packages.name, builds_times.arch, builds_times.duration, \
+					ROW_NUMBER() OVER ( \
+						PARTITION BY packages.name, builds_times.arch \
+						ORDER BY builds_times.time_finished DESC) AS n \
+				FROM builds_times \
+					JOIN builds ON builds_times.build_id = builds.id \
+					JOIN packages ON builds.pkg_id = packages.id \
+				WHERE (packages.name, builds_times.arch) IN (SELECT name, arch FROM selected) \
+			), \
+			durations AS ( \
+				SELECT name, arch, AVG(duration) AS duration FROM history \
+					WHERE n <= %%s GROUP BY name, arch \
+			) \
+			SELECT selected.id, selected.arch, durations.duration FROM selected \
+				LEFT JOIN durations ON selected.name = durations.name \
+					AND selected.arch = durations.arch" % condition,
+			*(args + (self.history_length,)))
+
+		# Use the average of the architecture for unknown packages
+		averages = self._get_averages()
+
+		durations = {}
+		for row in res:
+			durations[row.id] = row.duration \
+				or averages.get(row.arch, self.default_duration)
+
+		return durations
+
+	def _get_averages(self):
+		res = self.db.query("SELECT arch, AVG(duration) AS duration FROM builds_times \
+			WHERE time_finished >= NOW() - %s::interval GROUP BY arch", self.history)
+
+		return dict((row.arch, row.duration) for row in res)
+
+	def estimate_queue(self):
+		"""
+			Returns the expected durations of all jobs in the queue
+		"""
+		return self._estimate("jobs.id IN (SELECT job_id FROM jobs_queue)")
+
+	def plan(self, estimates=None):
+		"""
+			Assigns every long job in the queue to the builder that
+			will finish it the earliest and returns a dictionary that
+			maps job IDs to builder IDs
+		"""
+		if estimates is None:
+			estimates = self.estimate_queue()
+
+		long_jobs = [id for id, duration in estimates.items()
+			if duration >= self.long_job_threshold]
+
+		if not long_jobs:
+			return {}
+
+		builders = [b for b in self.backend.builders if b.enabled and b.is_online()]
+		if not builders:
+			return {}
+
+		# Find out when the jobs that are running right now will be done
+		running = self._estimate("jobs.builder_id = ANY(%s) AND jobs.state = ANY(%s)",
+			[b.id for b in builders], ["dispatching", "running", "uploading"])
+
+		# Every builder has max_jobs slots that become free at some time
+		slots = {}
+		for builder in builders:
+			free_at = []
+
+			for job in builder.active_jobs:
+				remaining = running.get(job.id, self.default_duration) - job.duration
+				free_at.append(max(remaining, 0) / builder.speed)
+
+			free_at.sort()
+			free_at = free_at[:builder.max_jobs]
+			free_at += [0] * (builder.max_jobs - len(free_at))
+
+			slots[builder] = free_at
+
+		jobs = self.backend.jobs.get_by_ids(long_jobs, prefetch=("build",))
+
+		# Schedule the longest jobs first (but respect priorities)
+		jobs.sort(key=lambda j: (-j.build.priority, -estimates[j.id]))
+
+		assignments = {}
+		for job in jobs:
+			best = None
+
+			for builder, free_at in slots.items():
+				if not free_at or not job.arch in builder.supported_arches:
+					continue
+
+				# Only allow building test jobs in test mode
+				if builder.testmode and not job.test:
+					continue
+
+				finished_at = free_at[0] + estimates[job.id] / builder.speed
+
+				if best is None or finished_at < best[0]:
+					best = (finished_at, builder)
+
+			if best is None:
+				continue
+
+			finished_at, builder = best
+
+			# The slot is busy until this job is finished
+			free_at = slots[builder]
+			free_at[0] = finished_at
+			free_at.sort()
+
+			assignments[job.id] = builder.id
+
+			log.debug("Reserved %s (%.0fs) for %s" % (job, estimates[job.id], builder))
+
+		return assignments
@@ -56,8 +56,12 @@ class Sources(base.Object):
 		return self._get_sources("SELECT * FROM sources")
 
 	def get_by_id(self, id):
-		return self._get_source("SELECT * FROM sources \
-			WHERE id = %s", id)
+		source = self.backend.objects.get(Source, id)
+		if source is None:
+			source = self._get_source("SELECT * FROM sources \
+				WHERE id = %s", id)
+
+		return source
 
 	def get_by_distro(self, distro):
 		return self._get_sources("SELECT * FROM sources \
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+
+import errno
+import logging
+import os
+import shutil
+import threading
+
+from . import base
+from . import misc
+
+from .constants import *
+
+log = logging.getLogger("storage")
+log.propagate = 1
+
+class Storage(base.Object):
+	"""
+		Keeps every file only once, named by its SHA512 hash
+
+		Build and repository directories only hold hardlinks to the files
+		in here, so that a package that is in many repositories uses its
+		disk space only once and adding it to another repository does
+		not need to copy any data.
+
+		The link count of a file is its reference count. When a link to a
+		file is deleted, cleanup() removes the file if it is not linked
+		from anywhere else any more.
+	"""
+	def get_path(self, hash):
+		return os.path.join(BLOBS_DIR, hash[:2], hash)
+
+	def add(self, path, hash=None):
+		"""
+			Adds the file at path to the store (unless it already is in
+			there) and returns its hash.
+		"""
+		if hash is None:
+			hash = misc.calc_hash(path, "sha512")
+
+		blob = self.get_path(hash)
+
+		# Nothing to do if we already have this file, but
+		# make sure that it is not removed right now
+		try:
+			os.utime(blob, None)
+			return hash
+
+		except OSError as e:
+			if not e.errno == errno.ENOENT:
+				raise
+
+		dirname = os.path.dirname(blob)
+		if not os.path.exists(dirname):
+			os.makedirs(dirname)
+
+		try:
+			os.link(path, blob)
+
+		except OSError as e:
+			# Somebody else was faster
+			if e.errno == errno.EEXIST:
+				return hash
+
+			# Copy the file if it cannot be linked (e.g. from another file system)
+			# and move it into place atomically
+			tmp = self._tmp_path(blob)
+			shutil.copy2(path, tmp)
+			os.rename(tmp, blob)
+
+		log.debug("Added %s as %s" % (path, hash))
+
+		return hash
+
+	def link(self, hash, dst, path=None):
+		"""
+			Creates dst as a reference to the file with the given hash
+			and replaces dst if it exists.
+
+			If the file is not in the store (any more), it is added
+			again from path.
+		"""
+		blob = self.get_path(hash)
+
+		log.debug("Linking %s to %s" % (hash, dst))
+
+		# Link to a temporary name first and then move it over dst
+		tmp = self._tmp_path(dst)
+
+		try:
+			os.link(blob, tmp)
+
+		except OSError as e:
+			if e.errno == errno.ENOENT and path:
+				self.add(path, hash=hash)
+
+				return self.link(hash, dst)
+
+			if not e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+				raise
+
+			shutil.copy2(blob, tmp)
+
+		try:
+			os.rename(tmp, dst)
+		except:
+			os.unlink(tmp)
+			raise
+
+	@staticmethod
+	def _tmp_path(path):
+		return "%s.%s-%s.tmp" % (path, os.getpid(), threading.current_thread().ident)
+
+	def cleanup(self, hashes):
+		"""
+			Removes the files with the given hashes from the
+			store unless they are still referenced
+
+			A file that is being added at the same time might be removed
+			here, but link() will add it again.
+		"""
+		for hash in hashes:
+			path = self.get_path(hash)
+
+			try:
+				st = os.lstat(path)
+			except OSError:
+				continue
+
+			# Skip anything that is still linked
+			if st.st_nlink > 1:
+				continue
+
+			try:
+				log.debug("Removing %s..." % path)
+				os.unlink(path)
+			except OSError as e:
+				log.error("Could not remove %s: %s" % (path, e))
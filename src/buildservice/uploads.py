@@ -2,11 +2,14 @@
 
 from __future__ import division
 
+import collections
 import datetime
 import hashlib
 import logging
 import os
 import shutil
+import threading
+import time
 
 import pakfire.packages
 
@@ -19,6 +22,15 @@ from .constants import *
 from .decorators import *
 
 class Uploads(base.Object):
+	# Keep the running hashes of at most this many uploads
+	max_hashes = 1024
+
+	def init(self):
+		# Maps the IDs of uploads to the number of bytes that have
+		# been hashed in order so far and the hash of them
+		self._hashes = collections.OrderedDict()
+		self._hashes_lock = threading.Lock()
+
 	def _get_upload(self, query, *args):
 		res = self.db.get(query, *args)
 
@@ -69,6 +81,54 @@ class Uploads(base.Object):
 		for upload in self:
 			upload.cleanup()
 
+	def take_hash(self, upload, pos):
+		"""
+			Returns the hash of the first pos bytes of upload so that
+			the caller can continue hashing from there, or None if
+			those bytes have not been hashed (in order).
+		"""
+		if pos == 0:
+			return hashlib.sha1()
+
+		with self._hashes_lock:
+			try:
+				hashed, h = self._hashes[upload.id]
+			except KeyError:
+				return None
+
+			if not hashed == pos:
+				return None
+
+			del self._hashes[upload.id]
+
+		return h
+
+	def put_hash(self, upload, pos, h):
+		"""
+			Stores the hash of the first pos bytes of upload
+		"""
+		with self._hashes_lock:
+			self._hashes.pop(upload.id, None)
+			self._hashes[upload.id] = (pos, h)
+
+			# Forget the oldest uploads
+			while len(self._hashes) > self.max_hashes:
+				self._hashes.popitem(last=False)
+
+	def get_digest(self, upload):
+		"""
+			Returns the digest of upload if all of its data has been hashed
+		"""
+		with self._hashes_lock:
+			hashed, h = self._hashes.get(upload.id, (None, None))
+
+		if hashed == upload.size:
+			return h.hexdigest()
+
+	def forget_hash(self, upload):
+		with self._hashes_lock:
+			self._hashes.pop(upload.id, None)
+
 
 class Upload(base.DataObject):
 	table = "uploads"
@@ -119,27 +179,93 @@ class Upload(base.DataObject):
 
 	user = lazy_property(get_user, set_user)
 
+	def open(self):
+		"""
+			Returns a writer that appends data to this upload
+		"""
+		return UploadWriter(self)
+
 	def append(self, data):
-		# Check if the filesize was exceeded.
-		size = os.path.getsize(self.path) + len(data)
-		if size > self.data.size:
-			raise Exception, "Given filesize was exceeded for upload %s" % self.uuid
+		with self.open() as writer:
+			writer.write(data)
 
-		logging.debug("Writing %s bytes to %s" % (len(data), self.path))
+	# Ranges
 
-		with open(self.path, "ab") as f:
-			f.write(data)
+	@property
+	def ranges(self):
+		"""
+			Returns a sorted list of all (start, end) ranges that have
+			been received so far. The end of each range is exclusive.
+		"""
+		res = self.db.query("SELECT range_start, range_end FROM uploads_ranges \
+			WHERE upload_id = %s ORDER BY range_start", self.id)
 
-		self._set_attribute("progress", size)
+		return merge_ranges((row.range_start, row.range_end) for row in res)
 
-	def validate(self):
+	@property
+	def missing_ranges(self):
+		"""
+			Returns all ranges that have not been received, yet
+		"""
+		missing = []
+
+		pos = 0
+		for start, end in self.ranges:
+			if start > pos:
+				missing.append((pos, start))
+
+			pos = end
+
+		if pos < self.size:
+			missing.append((pos, self.size))
+
+		return missing
+
+	def open_range(self, start, end):
+		"""
+			Returns a writer that writes the given range of this upload
+		"""
+		return UploadRangeWriter(self, start, end)
+
+	def add_range(self, start, end):
+		"""
+			Marks the given range as received
+		"""
+		with self.db.transaction():
+			# Lock the upload so that concurrent chunks do not overwrite each other
+			self.db.execute("SELECT 1 FROM uploads WHERE id = %s FOR UPDATE", self.id)
+
+			# Merge the new range with all existing ones so that
+			# only a few rows are kept for each upload
+			ranges = merge_ranges(self.ranges + [(start, end)])
+
+			self.db.execute("DELETE FROM uploads_ranges WHERE upload_id = %s", self.id)
+			self.db.executemany("INSERT INTO uploads_ranges(upload_id, range_start, range_end) \
+				VALUES(%s, %s, %s)", ((self.id, s, e) for s, e in ranges))
+
+			self._set_attribute("progress", sum(e - s for s, e in ranges))
+
+	def validate(self, hash=None):
 		size = os.path.getsize(self.path)
 		if not size == self.data.size:
 			logging.error("Filesize is not okay: %s" % (self.uuid))
 			return False
 
-		# Calculate a hash to validate the upload.
-		hash = misc.calc_hash(self.path, "sha1")
+		# Files that were uploaded in ranges are preallocated
+		# and therefore need to be checked for holes
+		ranges = self.ranges
+		if ranges and not ranges == [(0, self.size)]:
+			logging.error("Upload is incomplete: %s" % self.uuid)
+			return False
+
+		# Use the hash of the data that has been calculated while
+		# it was written. Only read the whole file again if it has
+		# not been written in order.
+		if hash is None:
+			hash = self.backend.uploads.get_digest(self)
+
+		if hash is None:
+			hash = misc.calc_hash(self.path, "sha1")
 
 		if not self.hash == hash:
 			logging.error("Hash did not match: %s != %s" % (self.hash, hash))
@@ -147,21 +273,25 @@ class Upload(base.DataObject):
 
 		return True
 
-	def finished(self):
+	def finished(self, hash=None):
 		"""
 			Update the status of the upload in the database to "finished".
 		"""
 		# Check if the file was completely uploaded and the hash is correct.
 		# If not, the upload has failed.
-		if not self.validate():
+		if not self.validate(hash=hash):
 			return False
 
+		self.backend.uploads.forget_hash(self)
+
 		self._set_attribute("finished", True)
 		self._set_attribute("time_finished", datetime.datetime.utcnow())
 
 		return True
 
 	def remove(self):
+		self.backend.uploads.forget_hash(self)
+
 		# Remove the uploaded data.
 		path = os.path.dirname(self.path)
 		if os.path.exists(path):
@@ -196,3 +326,178 @@ class Upload(base.DataObject):
 		# Remove uploads that are older than 2 hours.
 		if self.time_running >= 3600 * 2:
 			self.remove()
+
+
+class UploadWriter(object):
+	"""
+		Writes a stream of data to an upload
+
+		The file is kept open and all data is hashed while it is being
+		written (continuing the hash of any previous writer) so that the
+		upload does not have to be read again when it is finished.
+		Progress is only written to the database every couple of seconds.
+	"""
+	# Write the progress to the database at most this often (in seconds)
+	progress_interval = 5
+
+	def __init__(self, upload):
+		self.upload = upload
+
+		self.f = open(self.upload.path, "ab")
+
+		# Continue where any previous writer has stopped
+		self.size = self.f.tell()
+
+		# We can only hash incrementally if all data before has been hashed
+		self.h = self.upload.backend.uploads.take_hash(self.upload, self.size)
+
+		self._progress_updated_at = time.time()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.close()
+
+	@property
+	def closed(self):
+		return self.f.closed
+
+	def write(self, data):
+		# Check if the filesize was exceeded.
+		size = self.size + len(data)
+		if size > self.upload.size:
+			raise Exception, "Given filesize was exceeded for upload %s" % self.upload.uuid
+
+		self.f.write(data)
+		self.size = size
+
+		if self.h:
+			self.h.update(data)
+
+		# Update the progress every now and then
+		now = time.time()
+		if now - self._progress_updated_at >= self.progress_interval:
+			self._update_progress(now)
+
+	def _update_progress(self, now=None):
+		self.upload._set_attribute("progress", self.size)
+
+		self._progress_updated_at = now or time.time()
+
+	def close(self):
+		if self.closed:
+			return
+
+		self.f.close()
+		self._update_progress()
+
+		if self.h:
+			self.upload.backend.uploads.put_hash(self.upload, self.size, self.h)
+
+	def finish(self):
+		"""
+			Closes the file and marks the upload as finished if
+			all data has been received and the hash matches.
+		"""
+		self.close()
+
+		hash = None
+		if self.h:
+			hash = self.h.hexdigest()
+
+		return self.upload.finished(hash=hash)
+
+
+class UploadRangeWriter(object):
+	"""
+		Writes data to a range of an upload
+
+		Ranges can be written in any order and at the same time, because
+		every writer has its own file descriptor and writes at its own
+		position in a file that has been preallocated to its final size.
+
+		A range that continues right where all data before it has been
+		hashed is hashed while it is written, too.
+	"""
+	def __init__(self, upload, start, end):
+		if start < 0 or start >= end or end > upload.size:
+			raise ValueError("Invalid range %s-%s for upload %s" % (start, end, upload.uuid))
+
+		self.upload = upload
+		self.start = start
+		self.end = end
+
+		self.fd = os.open(self.upload.path, os.O_WRONLY)
+
+		# Preallocate the file
+		if os.fstat(self.fd).st_size < self.upload.size:
+			os.ftruncate(self.fd, self.upload.size)
+
+		os.lseek(self.fd, self.start, os.SEEK_SET)
+		self.pos = self.start
+
+		self.h = self.upload.backend.uploads.take_hash(self.upload, self.start)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.close()
+
+	@property
+	def closed(self):
+		return self.fd is None
+
+	def write(self, data):
+		if self.pos + len(data) > self.end:
+			raise Exception, "Range %s-%s was exceeded for upload %s" \
+				% (self.start, self.end, self.upload.uuid)
+
+		while data:
+			n = os.write(self.fd, data)
+
+			if self.h:
+				self.h.update(data[:n])
+
+			self.pos += n
+			data = data[n:]
+
+	def close(self):
+		if self.closed:
+			return
+
+		os.close(self.fd)
+		self.fd = None
+
+		if self.h:
+			self.upload.backend.uploads.put_hash(self.upload, self.pos, self.h)
+
+	def finish(self):
+		"""
+			Closes the file and marks the range as received if it
+			has been written entirely.
+		"""
+		self.close()
+
+		if not self.pos == self.end:
+			return False
+
+		self.upload.add_range(self.start, self.end)
+
+		return True
+
+
+def merge_ranges(ranges):
+	"""
+		Merges overlapping and adjacent (start, end) ranges
+	"""
+	merged = []
+
+	for start, end in sorted(ranges):
+		if merged and start <= merged[-1][1]:
+			merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+		else:
+			merged.append((start, end))
+
+	return merged
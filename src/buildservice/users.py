@@ -151,6 +151,12 @@ class Users(base.Object):
 		if None in (name, password):
 			return
 
+		# Have these credentials been verified recently?
+		user_id = self.backend.credentials.get("user", name, password)
+		if user_id:
+			return self._get_user("SELECT * FROM users \
+				WHERE id = %s AND activated IS TRUE AND deleted IS FALSE", user_id)
+
 		# usually we will get an email address as name
 		user = self.get_by_email(name) or self.get_by_name(name)
 
@@ -169,14 +175,26 @@ class Users(base.Object):
 
 		# Check if the password matches
 		if user.check_password(password):
+			self.backend.credentials.set("user", name, password, user.id)
+
 			return user
 
 	def email_in_use(self, email):
 		return self._get_user_email("SELECT * FROM users_emails \
 			WHERE email = %s AND activated IS TRUE", email)
 
+	def get_by_ids(self, ids):
+		"""
+			Fetches all users with the given IDs in one query
+		"""
+		return self._get_by_ids(self._get_users, "users", ids)
+
 	def get_by_id(self, id):
-		return self._get_user("SELECT * FROM users WHERE id = %s", id)
+		user = self.backend.objects.get(User, id)
+		if user is None:
+			user = self._get_user("SELECT * FROM users WHERE id = %s", id)
+
+		return user
 
 	def get_by_name(self, name):
 		return self._get_user("SELECT * FROM users WHERE name = %s", name)
@@ -288,6 +306,8 @@ class User(base.DataObject):
 	def delete(self):
 		self._set_attribute("deleted", True)
 
+		self.backend.credentials.invalidate("user", self.id)
+
 	def activate(self):
 		self._set_attribute("activated", True)
 
@@ -311,6 +331,9 @@ class User(base.DataObject):
 		self.db.execute("UPDATE users SET passphrase = %s WHERE id = %s",
 			generate_password_hash(passphrase), self.id)
 
+		# The old passphrase must not be accepted any more
+		self.backend.credentials.invalidate("user", self.id)
+
 	passphrase = property(lambda x: None, set_passphrase)
 
 	def get_realname(self):
@@ -41,6 +41,56 @@ $$;
 
 ALTER FUNCTION public.on_update_current_timestamp_sources() OWNER TO pakfire;
 
+--
+-- Name: jobs_queue_update(); Type: FUNCTION; Schema: public; Owner: pakfire
+--
+
+CREATE FUNCTION jobs_queue_update() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    _priority integer;
+BEGIN
+    DELETE FROM jobs_queue WHERE job_id = NEW.id;
+
+    -- Only jobs that are waiting and whose dependencies are satisfied are queued
+    IF NEW.state = 'pending' AND NEW.dependency_check_succeeded IS TRUE THEN
+        SELECT priority INTO _priority FROM builds WHERE id = NEW.build_id;
+
+        INSERT INTO jobs_queue(job_id, arch, test, priority, time_created)
+            VALUES(NEW.id, NEW.arch, NEW.test, _priority, NEW.time_created);
+
+        -- Wake up the hub
+        PERFORM pg_notify('jobs_queue', json_build_object(
+            'job_id', NEW.id, 'arch', NEW.arch, 'test', NEW.test,
+            'priority', _priority, 'time_created', extract(epoch FROM NEW.time_created))::text);
+    END IF;
+
+    RETURN NULL;
+END;
+$$;
+
+
+ALTER FUNCTION public.jobs_queue_update() OWNER TO pakfire;
+
+--
+-- Name: jobs_queue_update_priority(); Type: FUNCTION; Schema: public; Owner: pakfire
+--
+
+CREATE FUNCTION jobs_queue_update_priority() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    UPDATE jobs_queue SET priority = NEW.priority
+        FROM jobs WHERE jobs_queue.job_id = jobs.id AND jobs.build_id = NEW.id;
+
+    RETURN NULL;
+END;
+$$;
+
+
+ALTER FUNCTION public.jobs_queue_update_priority() OWNER TO pakfire;
+
 SET default_tablespace = '';
 
 SET default_with_oids = false;
@@ -167,6 +217,67 @@ ALTER TABLE builders_history_id_seq OWNER TO pakfire;
 ALTER SEQUENCE builders_history_id_seq OWNED BY builders_history.id;
 
 
+--
+-- Name: builders_stats; Type: TABLE; Schema: public; Owner: pakfire; Tablespace: 
+--
+
+CREATE TABLE builders_stats (
+    builder_id integer NOT NULL,
+    "time" timestamp without time zone NOT NULL,
+    loadavg1 double precision,
+    loadavg5 double precision,
+    loadavg15 double precision,
+    mem_total bigint,
+    mem_free bigint,
+    swap_total bigint,
+    swap_free bigint,
+    space_free bigint
+);
+
+
+ALTER TABLE builders_stats OWNER TO pakfire;
+
+--
+-- Name: builders_stats_minutely; Type: TABLE; Schema: public; Owner: pakfire; Tablespace: 
+--
+
+CREATE TABLE builders_stats_minutely (
+    builder_id integer NOT NULL,
+    "time" timestamp without time zone NOT NULL,
+    loadavg1 double precision,
+    loadavg5 double precision,
+    loadavg15 double precision,
+    mem_total bigint,
+    mem_free bigint,
+    swap_total bigint,
+    swap_free bigint,
+    space_free bigint
+);
+
+
+ALTER TABLE builders_stats_minutely OWNER TO pakfire;
+
+--
+-- Name: builders_stats_hourly; Type: TABLE; Schema: public; Owner: pakfire; Tablespace: 
+--
+
+CREATE TABLE builders_stats_hourly (
+    builder_id integer NOT NULL,
+    "time" timestamp without time zone NOT NULL,
+    loadavg1 double precision,
+    loadavg5 double precision,
+    loadavg15 double precision,
+    mem_total bigint,
+    mem_free bigint,
+    swap_total bigint,
+    swap_free bigint,
+    space_free bigint
+);
+
+
+ALTER TABLE builders_stats_hourly OWNER TO pakfire;
+
+
 --
 -- Name: builders_id_seq; Type: SEQUENCE; Schema: public; Owner: pakfire
 --
@@ -416,7 +527,9 @@ ALTER TABLE jobs OWNER TO pakfire;
 CREATE VIEW builds_times AS
  SELECT jobs.build_id,
     jobs.arch,
-    date_part('epoch'::text, (jobs.time_finished - jobs.time_started)) AS duration
+    date_part('epoch'::text, (jobs.time_finished - jobs.time_started)) AS duration,
+    jobs.builder_id,
+    jobs.time_finished
    FROM jobs
   WHERE ((jobs.test IS FALSE) AND (jobs.state = 'finished'::text));
 
@@ -671,20 +784,16 @@ ALTER SEQUENCE jobs_packages_id_seq OWNED BY jobs_packages.id;
 
 
 --
--- Name: jobs_queue; Type: VIEW; Schema: public; Owner: pakfire
+-- Name: jobs_queue; Type: TABLE; Schema: public; Owner: pakfire; Tablespace: 
 --
 
-CREATE VIEW jobs_queue AS
- WITH queue AS (
-         SELECT jobs.id,
-            rank() OVER (ORDER BY (NOT jobs.test), builds.priority DESC, jobs.time_created) AS rank
-           FROM (jobs
-             LEFT JOIN builds ON ((jobs.build_id = builds.id)))
-          WHERE ((jobs.state = 'pending'::text) AND (jobs.dependency_check_succeeded IS TRUE))
-        )
- SELECT queue.id AS job_id,
-    queue.rank
-   FROM queue;
+CREATE TABLE jobs_queue (
+    job_id integer NOT NULL,
+    arch text NOT NULL,
+    test boolean NOT NULL,
+    priority integer NOT NULL,
+    time_created timestamp without time zone NOT NULL
+);
 
 
 ALTER TABLE jobs_queue OWNER TO pakfire;
@@ -1002,6 +1111,18 @@ CREATE TABLE packages_deps (
 
 ALTER TABLE packages_deps OWNER TO pakfire;
 
+--
+-- Name: packages_index_cache; Type: TABLE; Schema: public; Owner: pakfire; Tablespace: 
+--
+
+CREATE TABLE packages_index_cache (
+    hash_sha512 text NOT NULL,
+    metadata text NOT NULL
+);
+
+
+ALTER TABLE packages_index_cache OWNER TO pakfire;
+
 --
 -- Name: packages_id_seq; Type: SEQUENCE; Schema: public; Owner: pakfire
 --
@@ -1065,7 +1186,8 @@ ALTER SEQUENCE packages_properties_id_seq OWNED BY packages_properties.id;
 CREATE TABLE queue_delete (
     id integer NOT NULL,
     path text NOT NULL,
-    not_before timestamp without time zone
+    not_before timestamp without time zone,
+    hash_sha512 text
 );
 
 
@@ -1222,6 +1344,20 @@ CREATE TABLE repositories_history (
 
 ALTER TABLE repositories_history OWNER TO pakfire;
 
+--
+-- Name: repositories_indexes; Type: TABLE; Schema: public; Owner: pakfire; Tablespace: 
+--
+
+CREATE TABLE repositories_indexes (
+    repo_id integer NOT NULL,
+    arch text NOT NULL,
+    filename text NOT NULL,
+    hash_sha512 text NOT NULL
+);
+
+
+ALTER TABLE repositories_indexes OWNER TO pakfire;
+
 --
 -- Name: repositories_id_seq; Type: SEQUENCE; Schema: public; Owner: pakfire
 --
@@ -1418,6 +1554,21 @@ ALTER TABLE uploads_id_seq OWNER TO pakfire;
 ALTER SEQUENCE uploads_id_seq OWNED BY uploads.id;
 
 
+--
+-- Name: uploads_ranges; Type: TABLE; Schema: public; Owner: pakfire; Tablespace: 
+--
+
+CREATE TABLE uploads_ranges (
+    upload_id integer NOT NULL,
+    range_start bigint NOT NULL,
+    range_end bigint NOT NULL,
+    CONSTRAINT uploads_ranges_check CHECK ((range_start < range_end))
+);
+
+
+ALTER TABLE uploads_ranges OWNER TO pakfire;
+
+
 --
 -- Name: users; Type: TABLE; Schema: public; Owner: pakfire; Tablespace: 
 --
@@ -1815,6 +1966,22 @@ ALTER TABLE ONLY builders_history
     ADD CONSTRAINT idx_2197982_primary PRIMARY KEY (id);
 
 
+--
+-- Name: builders_stats_minutely_pkey; Type: CONSTRAINT; Schema: public; Owner: pakfire; Tablespace: 
+--
+
+ALTER TABLE ONLY builders_stats_minutely
+    ADD CONSTRAINT builders_stats_minutely_pkey PRIMARY KEY (builder_id, "time");
+
+
+--
+-- Name: builders_stats_hourly_pkey; Type: CONSTRAINT; Schema: public; Owner: pakfire; Tablespace: 
+--
+
+ALTER TABLE ONLY builders_stats_hourly
+    ADD CONSTRAINT builders_stats_hourly_pkey PRIMARY KEY (builder_id, "time");
+
+
 --
 -- Name: idx_2197988_primary; Type: CONSTRAINT; Schema: public; Owner: pakfire; Tablespace: 
 --
@@ -1895,6 +2062,14 @@ ALTER TABLE ONLY jobs
     ADD CONSTRAINT idx_2198063_primary PRIMARY KEY (id);
 
 
+--
+-- Name: jobs_queue_pkey; Type: CONSTRAINT; Schema: public; Owner: pakfire; Tablespace: 
+--
+
+ALTER TABLE ONLY jobs_queue
+    ADD CONSTRAINT jobs_queue_pkey PRIMARY KEY (job_id);
+
+
 --
 -- Name: idx_2198085_primary; Type: CONSTRAINT; Schema: public; Owner: pakfire; Tablespace: 
 --
@@ -2071,6 +2246,22 @@ ALTER TABLE ONLY repositories_builds
     ADD CONSTRAINT repositories_builds_unique UNIQUE (repo_id, build_id);
 
 
+--
+-- Name: packages_index_cache_pkey; Type: CONSTRAINT; Schema: public; Owner: pakfire; Tablespace: 
+--
+
+ALTER TABLE ONLY packages_index_cache
+    ADD CONSTRAINT packages_index_cache_pkey PRIMARY KEY (hash_sha512);
+
+
+--
+-- Name: repositories_indexes_pkey; Type: CONSTRAINT; Schema: public; Owner: pakfire; Tablespace: 
+--
+
+ALTER TABLE ONLY repositories_indexes
+    ADD CONSTRAINT repositories_indexes_pkey PRIMARY KEY (repo_id, arch, filename);
+
+
 --
 -- Name: sessions_pkey; Type: CONSTRAINT; Schema: public; Owner: pakfire; Tablespace: 
 --
@@ -2153,6 +2344,13 @@ ALTER TABLE filelists CLUSTER ON filelists_pkg_id;
 CREATE INDEX idx_2197982_builder_id ON builders_history USING btree (builder_id);
 
 
+--
+-- Name: builders_stats_time; Type: INDEX; Schema: public; Owner: pakfire; Tablespace: 
+--
+
+CREATE INDEX builders_stats_time ON builders_stats USING btree ("time");
+
+
 --
 -- Name: idx_2197988_pkg_id; Type: INDEX; Schema: public; Owner: pakfire; Tablespace: 
 --
@@ -2321,6 +2519,13 @@ CREATE INDEX idx_2198222_revision ON sources_commits USING btree (revision);
 CREATE UNIQUE INDEX idx_2198232_uuid ON uploads USING btree (uuid);
 
 
+--
+-- Name: uploads_ranges_upload_id; Type: INDEX; Schema: public; Owner: pakfire; Tablespace: 
+--
+
+CREATE INDEX uploads_ranges_upload_id ON uploads_ranges USING btree (upload_id, range_start);
+
+
 --
 -- Name: idx_2198244_name; Type: INDEX; Schema: public; Owner: pakfire; Tablespace: 
 --
@@ -2379,6 +2584,20 @@ CREATE INDEX jobs_buildroots_pkg_uuid ON jobs_buildroots USING btree (pkg_uuid);
 CREATE INDEX jobs_queue_ready ON jobs USING btree (id) WHERE ((state = 'new'::text) AND (dependency_check_succeeded IS TRUE));
 
 
+--
+-- Name: jobs_queue_order; Type: INDEX; Schema: public; Owner: pakfire; Tablespace: 
+--
+
+CREATE INDEX jobs_queue_order ON jobs_queue USING btree (test DESC, priority DESC, time_created);
+
+
+--
+-- Name: jobs_queue_arch_order; Type: INDEX; Schema: public; Owner: pakfire; Tablespace: 
+--
+
+CREATE INDEX jobs_queue_arch_order ON jobs_queue USING btree (arch, test DESC, priority DESC, time_created);
+
+
 --
 -- Name: jobs_time_finished; Type: INDEX; Schema: public; Owner: pakfire; Tablespace: 
 --
@@ -2423,6 +2642,20 @@ CREATE INDEX repositories_builds_repo_id ON repositories_builds USING btree (rep
 CREATE TRIGGER on_update_current_timestamp BEFORE UPDATE ON sources FOR EACH ROW EXECUTE PROCEDURE on_update_current_timestamp_sources();
 
 
+--
+-- Name: jobs_queue_update; Type: TRIGGER; Schema: public; Owner: pakfire
+--
+
+CREATE TRIGGER jobs_queue_update AFTER INSERT OR UPDATE OF state, dependency_check_succeeded, arch, test, time_created, build_id ON jobs FOR EACH ROW EXECUTE PROCEDURE jobs_queue_update();
+
+
+--
+-- Name: jobs_queue_update_priority; Type: TRIGGER; Schema: public; Owner: pakfire
+--
+
+CREATE TRIGGER jobs_queue_update_priority AFTER UPDATE OF priority ON builds FOR EACH ROW EXECUTE PROCEDURE jobs_queue_update_priority();
+
+
 --
 -- Name: arches_compat_build_arch; Type: FK CONSTRAINT; Schema: public; Owner: pakfire
 --
@@ -2447,6 +2680,28 @@ ALTER TABLE ONLY builders_history
     ADD CONSTRAINT builders_history_user_id FOREIGN KEY (user_id) REFERENCES users(id);
 
 
+--
+-- Name: builders_stats_builder_id; Type: FK CONSTRAINT; Schema: public; Owner: pakfire
+--
+
+ALTER TABLE ONLY builders_stats
+    ADD CONSTRAINT builders_stats_builder_id FOREIGN KEY (builder_id) REFERENCES builders(id);
+
+--
+-- Name: builders_stats_minutely_builder_id; Type: FK CONSTRAINT; Schema: public; Owner: pakfire
+--
+
+ALTER TABLE ONLY builders_stats_minutely
+    ADD CONSTRAINT builders_stats_minutely_builder_id FOREIGN KEY (builder_id) REFERENCES builders(id);
+
+--
+-- Name: builders_stats_hourly_builder_id; Type: FK CONSTRAINT; Schema: public; Owner: pakfire
+--
+
+ALTER TABLE ONLY builders_stats_hourly
+    ADD CONSTRAINT builders_stats_hourly_builder_id FOREIGN KEY (builder_id) REFERENCES builders(id);
+
+
 --
 -- Name: builds_bug_build_id; Type: FK CONSTRAINT; Schema: public; Owner: pakfire
 --
@@ -2591,6 +2846,14 @@ ALTER TABLE ONLY jobs_buildroots
     ADD CONSTRAINT jobs_buildroots_job_id FOREIGN KEY (job_id) REFERENCES jobs(id);
 
 
+--
+-- Name: jobs_queue_job_id; Type: FK CONSTRAINT; Schema: public; Owner: pakfire
+--
+
+ALTER TABLE ONLY jobs_queue
+    ADD CONSTRAINT jobs_queue_job_id FOREIGN KEY (job_id) REFERENCES jobs(id) ON DELETE CASCADE;
+
+
 --
 -- Name: jobs_history_builder_id; Type: FK CONSTRAINT; Schema: public; Owner: pakfire
 --
@@ -2751,6 +3014,14 @@ ALTER TABLE ONLY repositories_builds
     ADD CONSTRAINT repositories_builds_repo_id FOREIGN KEY (repo_id) REFERENCES repositories(id);
 
 
+--
+-- Name: repositories_indexes_repo_id; Type: FK CONSTRAINT; Schema: public; Owner: pakfire
+--
+
+ALTER TABLE ONLY repositories_indexes
+    ADD CONSTRAINT repositories_indexes_repo_id FOREIGN KEY (repo_id) REFERENCES repositories(id) ON DELETE CASCADE;
+
+
 --
 -- Name: repositories_distro_id; Type: FK CONSTRAINT; Schema: public; Owner: pakfire
 --
@@ -2863,6 +3134,14 @@ ALTER TABLE ONLY uploads
     ADD CONSTRAINT uploads_user_id FOREIGN KEY (user_id) REFERENCES users(id);
 
 
+--
+-- Name: uploads_ranges_upload_id; Type: FK CONSTRAINT; Schema: public; Owner: pakfire
+--
+
+ALTER TABLE ONLY uploads_ranges
+    ADD CONSTRAINT uploads_ranges_upload_id FOREIGN KEY (upload_id) REFERENCES uploads(id) ON DELETE CASCADE;
+
+
 --
 -- Name: users_emails_user_id; Type: FK CONSTRAINT; Schema: public; Owner: pakfire
 --
@@ -4,7 +4,9 @@ import logging
 import tornado.web
 
 from .. import Backend
+from . import dispatcher
 from . import handlers
+from . import keepalives
 
 class Application(tornado.web.Application):
 	def __init__(self, **settings):
@@ -24,6 +26,7 @@ class Application(tornado.web.Application):
 			# Builders
 			(r"/builders/info", handlers.BuildersInfoHandler),
 			(r"/builders/jobs/get", handlers.BuildersGetNextJobHandler),
+			(r"/builders/jobs/batch", handlers.BuildersJobsBatchHandler),
 			(r"/builders/jobs/queue", handlers.BuildersJobsQueueHandler),
 			(r"/builders/jobs/(.*)/addfile/(.*)", handlers.BuildersJobsAddFileHandler),
 			(r"/builders/jobs/(.*)/buildroot", handlers.BuildersJobsBuildrootHandler),
@@ -42,6 +45,7 @@ class Application(tornado.web.Application):
 			# Uploads
 			(r"/uploads/create", handlers.UploadsCreateHandler),
 			(r"/uploads/stream", handlers.UploadsStreamHandler),
+			(r"/uploads/(.*)/ranges", handlers.UploadsRangesHandler),
 			(r"/uploads/(.*)/sendchunk", handlers.UploadsSendChunkHandler),
 			(r"/uploads/(.*)/finished", handlers.UploadsFinishedHandler),
 			(r"/uploads/(.*)/destroy", handlers.UploadsDestroyHandler),
@@ -50,4 +54,16 @@ class Application(tornado.web.Application):
 		# Launch backend
 		self.backend = Backend()
 
+		# Hold the job queue in memory
+		self.dispatcher = dispatcher.Dispatcher(self.backend)
+		self.dispatcher.start()
+
+		# Write keepalives in batches
+		self.keepalives = keepalives.KeepaliveBuffer(self.backend)
+		self.keepalives.start()
+
 		logging.info("Successfully initialied application")
+
+	def shutdown(self):
+		# Don't lose any keepalives that have not been written, yet
+		self.keepalives.stop()
@@ -0,0 +1,344 @@
+#!/usr/bin/python
+
+import datetime
+import heapq
+import json
+import logging
+import threading
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+
+log = logging.getLogger("dispatcher")
+log.propagate = 1
+
+class Dispatcher(object):
+	"""
+		Holds the job queue in memory so that builders can be handed
+		their next job without querying the database.
+
+		There is one heap per architecture and type (test or release)
+		in the same order as the jobs_queue table, except that longer
+		jobs go first among jobs of the same priority. Long jobs that the
+		scheduler has reserved for a builder are held in a heap of that
+		builder. The heaps are loaded from the database on startup and
+		refreshed periodically, jobs that are dispatched by this process
+		are removed right away.
+
+		Jobs that enter the queue are announced by the database on the
+		jobs_queue channel. They are added immediately, and any builders
+		waiting for a job of that architecture are woken up.
+	"""
+	channel = "jobs_queue"
+
+	def __init__(self, backend, refresh_interval=15):
+		self.backend = backend
+		self.refresh_interval = refresh_interval
+
+		# Maps (arch, test) or ("builder", builder ID) to a heap
+		# of (sort key, job ID)
+		self._queues = {}
+
+		# Maps job IDs to the key of their heap and their sort key
+		self._jobs = {}
+
+		# Changes that have been made while the queue is being
+		# refreshed (one list for each running refresh)
+		self._changes = []
+
+		# Maps native architectures to everything they can build
+		self._compat = {}
+
+		self._lock = threading.Lock()
+
+		# Maps architectures to the futures of all waiting builders
+		self._waiters = {}
+
+		# The connection that listens for new jobs
+		self._listener = None
+
+	def __len__(self):
+		return len(self._jobs)
+
+	def start(self):
+		"""
+			Loads the queue and keeps refreshing it on the IOLoop
+		"""
+		self.refresh()
+
+		self._refresher = tornado.ioloop.PeriodicCallback(
+			self._refresh_async, self.refresh_interval * 1000)
+		self._refresher.start()
+
+		self.listen()
+
+	def listen(self):
+		"""
+			Starts listening for new jobs
+		"""
+		ioloop = tornado.ioloop.IOLoop.current()
+
+		try:
+			self._listener = self.backend.db.listen(self.channel)
+
+		# Try again later and rely on refreshing until then
+		except Exception:
+			log.error("Could not listen for new jobs", exc_info=True)
+
+			ioloop.add_timeout(datetime.timedelta(seconds=self.refresh_interval), self.listen)
+			return
+
+		ioloop.add_handler(self._listener.fileno(), self._on_notify, ioloop.READ)
+
+	def _on_notify(self, fd, events):
+		try:
+			self._listener.poll()
+
+		except Exception:
+			log.error("Lost the connection that listens for new jobs", exc_info=True)
+
+			tornado.ioloop.IOLoop.current().remove_handler(fd)
+			self._listener.close()
+
+			# Reconnect
+			self.listen()
+			return
+
+		while self._listener.notifies:
+			notify = self._listener.notifies.pop(0)
+
+			try:
+				job = json.loads(notify.payload)
+			except ValueError:
+				log.warning("Received an invalid notification: %s" % notify.payload)
+				continue
+
+			log.debug("Job %s has been queued" % job["job_id"])
+
+			time_created = datetime.datetime.utcfromtimestamp(job["time_created"])
+
+			self.add(job["job_id"], job["arch"], job["test"], job["priority"], time_created)
+
+			self.wake(job["arch"])
+
+	@tornado.gen.coroutine
+	def _refresh_async(self):
+		try:
+			yield self.backend.db.run_async(self.refresh)
+		except Exception:
+			log.error("Could not refresh the job queue", exc_info=True)
+
+	@staticmethod
+	def _sort_key(job_id, test, priority, time_created, duration=0):
+		# Longest job first among jobs with the same priority
+		return (not test, -priority, -duration, time_created, job_id)
+
+	def refresh(self):
+		"""
+			Reloads the entire queue from the database and asks the
+			scheduler which builders should build the long jobs
+
+			Jobs that are added or removed while the queue is being
+			loaded are added to or removed from the new queue, too.
+		"""
+		queues, jobs = {}, {}
+
+		# Record all changes from now on to apply them to the new queue
+		changes = []
+
+		with self._lock:
+			self._changes.append(changes)
+
+		try:
+			self._load(queues, jobs)
+
+			# Load all compatible architectures
+			compat = {}
+			for row in self.backend.db.query("SELECT * FROM arches_compat"):
+				compat.setdefault(row.native_arch, []).append(row.build_arch)
+
+		except:
+			with self._lock:
+				self._changes.remove(changes)
+
+			raise
+
+		with self._lock:
+			self._changes.remove(changes)
+
+			# Replay everything that has happened while loading
+			for job_id, entry in changes:
+				jobs.pop(job_id, None)
+
+				if entry:
+					self._push(queues, jobs, job_id, *entry)
+
+			self._queues, self._jobs = queues, jobs
+			self._compat = compat
+
+		log.debug("Loaded %s job(s) into the job queue" % len(jobs))
+
+	def _load(self, queues, jobs):
+		res = self.backend.db.query("SELECT * FROM jobs_queue")
+
+		estimates = self.backend.scheduler.estimate_queue()
+		assignments = self.backend.scheduler.plan(estimates)
+
+		for row in res:
+			builder_id = assignments.get(row.job_id)
+
+			if builder_id:
+				key = ("builder", builder_id)
+			else:
+				key = (row.arch, row.test)
+
+			sort_key = self._sort_key(row.job_id, row.test, row.priority,
+				row.time_created, estimates.get(row.job_id, 0))
+
+			queues.setdefault(key, []).append((sort_key, row.job_id))
+			jobs[row.job_id] = (key, sort_key)
+
+		for queue in queues.values():
+			heapq.heapify(queue)
+
+	def add(self, job_id, arch, test, priority, time_created):
+		"""
+			Adds a job to the queue (or moves it if it has changed)
+		"""
+		key = (arch, test)
+		sort_key = self._sort_key(job_id, test, priority, time_created)
+
+		with self._lock:
+			self._push(self._queues, self._jobs, job_id, key, sort_key)
+			self._record(job_id, (key, sort_key))
+
+	@staticmethod
+	def _push(queues, jobs, job_id, key, sort_key):
+		# An older entry of the job stays in the heap, but is
+		# dropped when it comes up because it does not match
+		heapq.heappush(queues.setdefault(key, []), (sort_key, job_id))
+		jobs[job_id] = (key, sort_key)
+
+	def remove(self, job_id):
+		with self._lock:
+			self._remove(job_id)
+
+	def _remove(self, job_id):
+		# Entries are removed from the heap when they come up
+		self._jobs.pop(job_id, None)
+		self._record(job_id, None)
+
+	def _record(self, job_id, entry):
+		for changes in self._changes:
+			changes.append((job_id, entry))
+
+	def wait(self, arches, timeout):
+		"""
+			Returns a future that resolves when a job for any of the
+			given arches has been queued or after timeout seconds
+		"""
+		future = tornado.concurrent.Future()
+
+		for arch in arches:
+			self._waiters.setdefault(arch, set()).add(future)
+
+		def done(future):
+			for arch in arches:
+				waiters = self._waiters.get(arch)
+
+				if waiters:
+					waiters.discard(future)
+
+		future.add_done_callback(done)
+
+		ioloop = tornado.ioloop.IOLoop.current()
+		timeout = ioloop.add_timeout(datetime.timedelta(seconds=timeout),
+			lambda: future.done() or future.set_result(False))
+
+		future.add_done_callback(lambda f: ioloop.remove_timeout(timeout))
+
+		return future
+
+	def wake(self, arch):
+		"""
+			Wakes up all builders that are waiting for jobs of arch
+		"""
+		waiters = self._waiters.get(arch, set())
+
+		for future in list(waiters):
+			if not future.done():
+				future.set_result(True)
+
+	def arches_for(self, builder):
+		arches = ["noarch"]
+
+		if builder.native_arch:
+			arches.append(builder.native_arch)
+			arches += self._compat.get(builder.native_arch, [])
+
+		return arches
+
+	def pop(self, builder):
+		"""
+			Removes the next job that builder may build from the
+			queue and returns its ID (or None)
+		"""
+		job_ids = self.pop_many(builder, 1)
+
+		if job_ids:
+			return job_ids[0]
+
+	def pop_many(self, builder, count):
+		"""
+			Removes up to count jobs that builder may build from the
+			queue and returns their IDs
+		"""
+		job_ids = []
+
+		# Don't send any jobs to disabled builders
+		if not builder.enabled:
+			return job_ids
+
+		# Jobs that have been reserved for this builder
+		keys = [("builder", builder.id)]
+
+		for arch in self.arches_for(builder):
+			for test in (True, False):
+				# Only allow building test jobs in test mode
+				if builder.testmode and not test:
+					continue
+
+				keys.append((arch, test))
+
+		with self._lock:
+			while len(job_ids) < count:
+				candidates = []
+
+				for key in keys:
+					queue = self._queues.get(key)
+					if not queue:
+						continue
+
+					# Drop all jobs that have been removed, moved or changed
+					while queue:
+						sort_key, job_id = queue[0]
+
+						if self._jobs.get(job_id) == (key, sort_key):
+							break
+
+						heapq.heappop(queue)
+
+					if queue:
+						candidates.append((queue[0], queue))
+
+				if not candidates:
+					break
+
+				(sort_key, job_id), queue = min(candidates)
+
+				heapq.heappop(queue)
+				self._remove(job_id)
+
+				job_ids.append(job_id)
+
+		return job_ids
@@ -1,14 +1,19 @@
 #!/usr/bin/python
 
 import base64
+import datetime
 import hashlib
 import json
 import logging
+import re
 import time
+import tornado.gen
+import tornado.ioloop
 import tornado.web
 
 from .. import builds
 from .. import builders
+from .. import database
 from .. import uploads
 from .. import users
 
@@ -19,7 +24,7 @@ class LongPollMixin(object):
 	def add_timeout(self, timeout, callback):
 		deadline = time.time() + timeout
 
-		return self.application.ioloop.add_timeout(deadline, callback)
+		return tornado.ioloop.IOLoop.current().add_timeout(deadline, callback)
 
 	def on_connection_close(self):
 		logging.debug("Connection closed unexpectedly")
@@ -33,6 +38,19 @@ class LongPollMixin(object):
 
 
 class BaseHandler(LongPollMixin, tornado.web.RequestHandler):
+	def initialize(self):
+		LongPollMixin.initialize(self)
+
+		# Counts all queries of this request. Handlers interleave on
+		# the IOLoop, so queries are counted explicitly instead of
+		# per thread.
+		self.query_counter = database.QueryCounter()
+
+	def finish(self, *args, **kwargs):
+		self.set_header("Server-Timing", self.query_counter.server_timing)
+
+		return tornado.web.RequestHandler.finish(self, *args, **kwargs)
+
 	@property
 	def backend(self):
 		"""
@@ -44,6 +62,17 @@ class BaseHandler(LongPollMixin, tornado.web.RequestHandler):
 	def db(self):
 		return self.backend.db
 
+	def run_async(self, callback, *args, **kwargs):
+		"""
+			Runs callback in a database thread and counts
+			its queries for this request
+		"""
+		def run():
+			with self.db.counting(self.query_counter):
+				return callback(*args, **kwargs)
+
+		return self.db.run_async(run)
+
 	def get_basic_auth_credentials(self):
 		"""
 			This handles HTTP Basic authentication.
@@ -73,6 +102,10 @@ class BaseHandler(LongPollMixin, tornado.web.RequestHandler):
 		if name is None:
 			return
 
+		with self.db.counting(self.query_counter):
+			return self._auth(name, password)
+
+	def _auth(self, name, password):
 		builder = self.backend.builders.auth(name, password)
 		if builder:
 			return builder
@@ -176,22 +209,113 @@ class UploadsStreamHandler(BaseHandler):
 		if not self.upload:
 			raise tornado.web.HTTPError(404)
 
+		# Open the file once for the whole request
+		self.writer = self.upload.open()
+
 	def data_received(self, data):
-		logging.debug("Received chunk of %s bytes" % len(data))
 		self.size += len(data)
 
 		# Write the received chunk to disk
-		with self.db.transaction():
-			self.upload.append(data)
+		self.writer.write(data)
 
 	def put(self):
 		logging.info("Received entire file (%s bytes)" % self.size)
 
 		with self.db.transaction():
-			self.upload.finished()
+			self.writer.finish()
 
 		self.finish("OK")
 
+	def on_finish(self):
+		writer = getattr(self, "writer", None)
+
+		# Make sure the file is closed when the request was aborted
+		if writer:
+			writer.close()
+
+	def on_connection_close(self):
+		BaseHandler.on_connection_close(self)
+
+		self.on_finish()
+
+
+@tornado.web.stream_request_body
+class UploadsRangesHandler(BaseHandler):
+	"""
+		Receives parts of an upload with PUT and a Content-Range header.
+
+		Parts may be sent in any order and in parallel. GET returns which
+		ranges have been received so far, so that an interrupted upload
+		can be resumed by sending only what is missing.
+	"""
+	content_range = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+
+	@tornado.web.authenticated
+	def prepare(self):
+		self.writer = None
+
+		upload_uuid = self.path_args[0]
+
+		self.upload = self.backend.uploads.get_by_uuid(upload_uuid)
+		if not self.upload:
+			raise tornado.web.HTTPError(404, "Invalid upload id.")
+
+		if self.builder and not self.upload.builder == self.builder:
+			raise tornado.web.HTTPError(403, "Uploading an other host's file.")
+
+		elif self.user and not self.upload.user == self.user:
+			raise tornado.web.HTTPError(403, "Uploading an other user's file.")
+
+		if self.request.method == "PUT":
+			m = self.content_range.match(self.request.headers.get("Content-Range", ""))
+			if not m:
+				raise tornado.web.HTTPError(400, "Invalid or missing Content-Range")
+
+			# The end of a HTTP range is inclusive
+			start, end, size = (int(i) for i in m.groups())
+
+			if not size == self.upload.size:
+				raise tornado.web.HTTPError(400, "Size does not match upload")
+
+			try:
+				self.writer = self.upload.open_range(start, end + 1)
+			except ValueError as e:
+				raise tornado.web.HTTPError(416, "%s" % e)
+
+	def data_received(self, data):
+		if self.writer:
+			self.writer.write(data)
+
+	def get(self, upload_uuid):
+		self._send_ranges()
+
+	def put(self, upload_uuid):
+		with self.db.transaction():
+			received = self.writer.finish()
+
+		if not received:
+			raise tornado.web.HTTPError(400, "Range was not received entirely")
+
+		self._send_ranges()
+
+	def _send_ranges(self):
+		self.finish({
+			"size"     : self.upload.size,
+			"received" : self.upload.ranges,
+			"missing"  : self.upload.missing_ranges,
+		})
+
+	def on_finish(self):
+		writer = getattr(self, "writer", None)
+
+		if writer:
+			writer.close()
+
+	def on_connection_close(self):
+		BaseHandler.on_connection_close(self)
+
+		self.on_finish()
+
 
 class UploadsSendChunkHandler(BaseHandler):
 	@tornado.web.authenticated
@@ -529,16 +653,76 @@ class BuildersKeepaliveHandler(BuildersBaseHandler):
 			# Disk space
 			"space_free" : self.get_argument_int("space_free", None),
 		}
-		self.builder.update_keepalive(**args)
+
+		# Store the keepalive with the next batch
+		self.application.keepalives.add(self.builder, **args)
 
 		self.finish("OK")
 
 
-class BuildersGetNextJobHandler(BuildersBaseHandler):
+class BuildersDispatchMixin(object):
+	def dispatch_job(self):
+		"""
+			Assigns the next job to the builder and returns
+			its serialised form (or None if there is no job)
+
+			This runs in a background thread.
+		"""
+		jobs = self.dispatch_jobs(1)
+
+		if jobs:
+			return jobs[0]
+
+	def dispatch_jobs(self, count):
+		"""
+			Assigns up to count jobs to the builder and returns
+			them in their serialised form
+
+			This runs in a background thread.
+		"""
+		jobs = []
+
+		with self.db.transaction():
+			# Hold the builder until all jobs have been claimed, so that concurrent
+			# requests of the same builder cannot exceed max_jobs together
+			self.builder.lock()
+
+			# Don't send any jobs to builders that are already running enough
+			if self.builder.too_many_jobs:
+				logging.debug("%s has too many jobs running" % self.builder)
+				return jobs
+
+			count = min(count, self.builder.free_slots)
+
+			while len(jobs) < count:
+				# Check if there are jobs for us.
+				job_ids = self.application.dispatcher.pop_many(self.builder, count - len(jobs))
+				if not job_ids:
+					break
+
+				# Skip jobs that have been taken care of since
+				# the queue has been loaded
+				jobs += self.backend.jobs.claim_many(self.builder, job_ids)
+
+		return [self._serialise_job(job) for job in jobs]
+
+	def _serialise_job(self, job):
+		return {
+			"id"                 : job.uuid,
+			"arch"               : job.arch,
+			"source_url"         : job.build.source_download,
+			"source_hash_sha512" : job.build.source_hash_sha512,
+			"type"               : "test" if job.test else "release",
+			"config"             : job.get_config(),
+		}
+
+
+class BuildersGetNextJobHandler(BuildersDispatchMixin, BuildersBaseHandler):
+	@tornado.gen.coroutine
 	def _retry_after(self, seconds):
 		# Consider the builder online until the time has passed
-		self.builder.online_until = \
-			datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)
+		online_until = datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)
+		yield self.run_async(self.builder.set_online_until, online_until)
 
 		# Set the Retry-After header
 		self.set_header("Retry-After", "%s" % seconds)
@@ -547,75 +731,76 @@ class BuildersGetNextJobHandler(BuildersBaseHandler):
 		self.finish()
 
 	@tornado.web.authenticated
+	@tornado.gen.coroutine
 	def get(self):
 		# If the builder is disabled, we don't need to do anything
 		# but will ask it to return after 5 min
 		if not self.builder.enabled:
-			return self._retry_after(300)
+			yield self._retry_after(300)
+			return
 
 		# If the builder has too many jobs running,
 		# we will tell it to return after 1 min
-		if self.builder.too_many_jobs:
-			return self._retry_after(60)
+		too_many_jobs = yield self.run_async(lambda: self.builder.too_many_jobs)
+		if too_many_jobs:
+			yield self._retry_after(60)
+			return
 
 		# Okay, we are ready for the next job
-		job = self.builder.get_next_job()
+		ret = yield self.run_async(self.dispatch_job)
 
 		# If we got no job, we will ask the builder
 		# to return after 30 seconds
-		if not job:
-			return self._retry_after(30)
-
-		# If we got a job, we will serialise it
-		# and send it to the builder
-		with self.db.transaction():
-			job.start(builder=self.builder)
+		if not ret:
+			yield self._retry_after(30)
+			return
 
-			ret = {
-				"id"                 : job.uuid,
-				"arch"               : job.arch,
-				"source_url"         : job.build.source_download,
-				"source_hash_sha512" : job.build.source_hash_sha512,
-				"type"               : "test" if job.test else "release",
-				"config"             : job.get_config(),
-			}
-			self.finish(ret)
+		# If we got a job, we will send it to the builder
+		self.finish(ret)
 
 
-class BuildersJobsQueueHandler(BuildersBaseHandler):
-	@tornado.web.asynchronous
+class BuildersJobsBatchHandler(BuildersDispatchMixin, BuildersBaseHandler):
 	@tornado.web.authenticated
+	@tornado.gen.coroutine
 	def get(self):
-		self.callback()
+		"""
+			Returns as many jobs as the builder asks for
+			and has free slots for
+		"""
+		count = self.get_argument_int("count", None)
 
-	def callback(self):
-		# Break if the connection has been closed in the mean time.
-		if self.connection_closed():
-			logging.warning("Connection closed")
-			return
+		# Never hand out more jobs than the builder can run
+		free_slots = yield self.run_async(lambda: self.builder.free_slots)
 
-		with self.db.transaction():
-			# Check if there is a job for us.
-			job = self.builder.get_next_job()
+		if count is None or count > free_slots:
+			count = free_slots
+
+		jobs = []
+		if count > 0:
+			jobs = yield self.run_async(self.dispatch_jobs, count)
 
-			# Got no job, wait and try again.
-			if not job:
-				return self.add_timeout(self.heartbeat, self.callback)
+		self.finish({ "jobs" : jobs })
 
-			# We got a job!
-			job.start(builder=self.builder)
 
-			ret = {
-				"id"                 : job.uuid,
-				"arch"               : job.arch,
-				"source_url"         : job.build.source_download,
-				"source_hash_sha512" : job.build.source_hash_sha512,
-				"type"               : "test" if job.test else "release",
-				"config"             : job.get_config(),
-			}
+class BuildersJobsQueueHandler(BuildersDispatchMixin, BuildersBaseHandler):
+	@tornado.web.authenticated
+	@tornado.gen.coroutine
+	def get(self):
+		dispatcher = self.application.dispatcher
+
+		while not self.connection_closed():
+			ret = yield self.run_async(self.dispatch_job)
 
 			# Send build information to the builder.
-			self.finish(ret)
+			if ret:
+				self.finish(ret)
+				return
+
+			# Got no job, wait until a new job has been queued
+			# for us or try again after the heartbeat
+			yield dispatcher.wait(dispatcher.arches_for(self.builder), self.heartbeat)
+
+		logging.warning("Connection closed")
 
 	@property
 	def heartbeat(self):
@@ -632,8 +817,9 @@ class BuildersJobsQueueHandler(BuildersBaseHandler):
 
 class BuildersJobsStateHandler(BuildersBaseHandler):
 	@tornado.web.authenticated
+	@tornado.gen.coroutine
 	def post(self, job_uuid, state):
-		job = self.backend.jobs.get_by_uuid(job_uuid)
+		job = yield self.run_async(self.backend.jobs.get_by_uuid, job_uuid)
 		if not job:
 			raise tornado.web.HTTPError(404, "Invalid job id.")
 
@@ -643,6 +829,11 @@ class BuildersJobsStateHandler(BuildersBaseHandler):
 		message = self.get_argument("message", None)
 
 		# Save information to database.
+		yield self.run_async(self._set_state, job, state, message)
+
+		self.finish("OK")
+
+	def _set_state(self, job, state, message=None):
 		with self.db.transaction():
 			if state == "running":
 				job.running()
@@ -653,8 +844,6 @@ class BuildersJobsStateHandler(BuildersBaseHandler):
 			else:
 				job.state = state
 
-		self.finish("OK")
-
 
 class BuildersJobsBuildrootHandler(BuildersBaseHandler):
 	@tornado.web.authenticated
@@ -676,12 +865,13 @@ class BuildersJobsBuildrootHandler(BuildersBaseHandler):
 
 class BuildersJobsAddFileHandler(BuildersBaseHandler):
 	@tornado.web.authenticated
+	@tornado.gen.coroutine
 	def post(self, job_uuid, upload_id):
 		type = self.get_argument("type")
 		assert type in ("package", "log")
 
 		# Fetch job we are working on and check if it is actually ours.
-		job = self.backend.jobs.get_by_uuid(job_uuid)
+		job = yield self.run_async(self.backend.jobs.get_by_uuid, job_uuid)
 		if not job:
 			raise tornado.web.HTTPError(404, "Invalid job id.")
 
@@ -689,18 +879,22 @@ class BuildersJobsAddFileHandler(BuildersBaseHandler):
 			raise tornado.web.HTTPError(403, "Altering another builder's job.")
 
 		# Fetch uploaded file object and check we uploaded it ourself.
-		upload = self.backend.uploads.get_by_uuid(upload_id)
+		upload = yield self.run_async(self.backend.uploads.get_by_uuid, upload_id)
 		if not upload:
 			raise tornado.web.HTTPError(404, "Invalid upload id.")
 
 		if not upload.builder == self.builder:
 			raise tornado.web.HTTPError(403, "Using an other host's file.")
 
+		# Importing the file might take a while
+		yield self.run_async(self._add_file, job, upload)
+
+		self.finish("OK")
+
+	def _add_file(self, job, upload):
 		try:
 			job.add_file(upload.path)
 
 		finally:
 			# Finally, remove the uploaded file.
 			upload.remove()
-
-		self.finish("OK")
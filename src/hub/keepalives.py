@@ -0,0 +1,99 @@
+#!/usr/bin/python
+
+import datetime
+import logging
+import threading
+import tornado.gen
+import tornado.ioloop
+
+log = logging.getLogger("keepalives")
+log.propagate = 1
+
+class KeepaliveBuffer(object):
+	"""
+		Collects the keepalives of all builders and writes them to the
+		database in one batch every few seconds instead of updating the
+		builders table on every single request.
+
+		At most maxsize keepalives are held (i.e. while the database is
+		not available). When there are more, the oldest ones are dropped.
+	"""
+	def __init__(self, backend, flush_interval=10, maxsize=10000):
+		self.backend = backend
+		self.flush_interval = flush_interval
+		self.maxsize = maxsize
+
+		self._keepalives = []
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._keepalives)
+
+	def start(self):
+		self._flusher = tornado.ioloop.PeriodicCallback(
+			self._flush_async, self.flush_interval * 1000)
+		self._flusher.start()
+
+	def stop(self):
+		"""
+			Stops flushing periodically and writes everything
+			that is left to the database
+		"""
+		self._flusher.stop()
+
+		try:
+			self.flush()
+		except Exception:
+			log.error("Could not store %s keepalive(s)" % len(self), exc_info=True)
+
+	def add(self, builder, loadavg1=None, loadavg5=None, loadavg15=None,
+			mem_total=None, mem_free=None, swap_total=None, swap_free=None,
+			space_free=None):
+		keepalive = (builder.id, datetime.datetime.utcnow(), loadavg1, loadavg5,
+			loadavg15, mem_total, mem_free, swap_total, swap_free, space_free)
+
+		with self._lock:
+			self._keepalives.append(keepalive)
+			self._trim()
+
+	def _trim(self):
+		"""
+			Drops the oldest keepalives if there are too many
+		"""
+		excess = len(self._keepalives) - self.maxsize
+
+		if excess > 0:
+			log.warning("Dropping %s keepalive(s)" % excess)
+			del self._keepalives[:excess]
+
+	@tornado.gen.coroutine
+	def _flush_async(self):
+		if not self._keepalives:
+			return
+
+		try:
+			yield self.backend.db.run_async(self.flush)
+		except Exception:
+			log.error("Could not store keepalives", exc_info=True)
+
+	def flush(self):
+		"""
+			Writes all collected keepalives to the database
+		"""
+		with self._lock:
+			keepalives, self._keepalives = self._keepalives, []
+
+		if not keepalives:
+			return
+
+		try:
+			self.backend.builders.update_keepalives(keepalives)
+
+		# Keep the keepalives for the next attempt
+		except:
+			with self._lock:
+				self._keepalives[:0] = keepalives
+				self._trim()
+			raise
+
+		log.debug("Stored %s keepalive(s)" % len(keepalives))
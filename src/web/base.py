@@ -12,6 +12,31 @@ from .. import misc
 from ..decorators import *
 
 class BaseHandler(tornado.web.RequestHandler):
+	def initialize(self):
+		read_only = self.request.method in ("GET", "HEAD")
+
+		# Share all objects that are loaded while handling a request
+		# that does not change anything
+		if read_only:
+			self.backend.objects.begin()
+
+		# Count all queries of this request
+		self.query_counter = self.db.begin_counting()
+
+		# Requests that should not change anything may read from the replica
+		self.db.set_read_only(read_only)
+
+	def finish(self, *args, **kwargs):
+		self.set_header("Server-Timing", self.query_counter.server_timing)
+
+		return tornado.web.RequestHandler.finish(self, *args, **kwargs)
+
+	def on_finish(self):
+		self.db.set_read_only(False)
+		self.db.end_counting()
+
+		self.backend.objects.end()
+
 	@property
 	def backend(self):
 		return self.application.backend
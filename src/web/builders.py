@@ -16,7 +16,8 @@ class BuilderDetailHandler(base.BaseHandler):
 			raise tornado.web.HTTPError(404, "Could not find builder %s" % hostname)
 
 		# Get running and pending jobs.
-		jobs = builder.active_jobs + list(builder.jobqueue)
+		jobs = builder.active_jobs \
+			+ list(self.backend.jobqueue.for_arches(builder.supported_arches))
 
 		# Get log.
 		log = builder.get_history(limit=5)
@@ -20,6 +20,9 @@ class BuildsHandler(base.BaseHandler):
 			if not limit:
 				break
 
+		# Load everything the build table shows at once
+		self.backend.builds.prefetch(builds, ("pkg", "owner", "jobs", "jobs.builder"))
+
 		self.render("build-index.html", builds=builds)
 
 
@@ -203,7 +206,10 @@ class BuildStateHandler(base.BaseHandler):
 
 class BuildQueueHandler(base.BaseHandler):
 	def get(self):
-		self.render("build-queue.html", jobs=self.backend.jobqueue,
+		jobs = self.backend.jobs.prefetch(self.backend.jobqueue,
+			("build", "build.pkg", "builder"))
+
+		self.render("build-queue.html", jobs=jobs,
 			average_waiting_time=self.backend.jobqueue.average_waiting_time)
 
 
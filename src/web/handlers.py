@@ -14,6 +14,9 @@ class IndexHandler(base.BaseHandler):
 		# Get some recently finished jobs
 		jobs += self.backend.jobs.get_recently_ended(limit=12)
 
+		# Load the builds and builders of all jobs at once
+		self.backend.jobs.prefetch(jobs, ("build", "build.pkg", "builder"))
+
 		# Updates
 		updates = []
 		active = True
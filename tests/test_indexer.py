@@ -0,0 +1,102 @@
+#!/usr/bin/python
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+try:
+	import pakfire
+	from buildservice import indexer
+except ImportError:
+	pakfire = None
+
+# A directory with some binary packages of the same architecture
+FIXTURE_REPO = os.environ.get("PBS_TEST_REPO",
+	os.path.join(os.path.dirname(__file__), "data", "repo"))
+
+ARCH = os.environ.get("PBS_TEST_ARCH", "x86_64")
+
+def find_packages(path):
+	if not os.path.isdir(path):
+		return []
+
+	return sorted(f for f in os.listdir(path) if f.endswith(".pfm"))
+
+
+@unittest.skipIf(pakfire is None, "pakfire is not installed")
+class IndexerTest(unittest.TestCase):
+	def setUp(self):
+		self.filenames = find_packages(FIXTURE_REPO)
+
+		if not self.filenames:
+			self.skipTest("No packages in %s" % FIXTURE_REPO)
+
+		self.tmpdir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def make_repo(self, name):
+		path = os.path.join(self.tmpdir, name)
+		os.makedirs(path)
+
+		for filename in self.filenames:
+			shutil.copy2(os.path.join(FIXTURE_REPO, filename), path)
+
+		return path
+
+	def read_repodata(self, path):
+		"""
+			Returns the content of all files in the repodata directory
+			except the manifest which contains timestamps
+		"""
+		res = {}
+
+		repodata = os.path.join(path, "repodata")
+		for dirpath, dirnames, filenames in os.walk(repodata):
+			for filename in filenames:
+				if filename == "repomd.json":
+					continue
+
+				filename = os.path.join(dirpath, filename)
+
+				with open(filename, "rb") as f:
+					res[os.path.relpath(filename, repodata)] = f.read()
+
+		return res
+
+	def test_index_matches_repo_create(self):
+		name = "Test Repository"
+
+		# Let pakfire read all packages
+		expected = self.make_repo("expected")
+
+		p = pakfire.PakfireServer(arch=ARCH)
+		p.repo_create(expected, [os.path.join(expected, f) for f in self.filenames], name=name)
+
+		# Write the index from the (serialised) metadata
+		path = self.make_repo("indexer")
+
+		i = indexer.Indexer(None)
+
+		entries = []
+		for filename in self.filenames:
+			metadata = i._read_metadata(os.path.join(path, filename))
+
+			# Go through the same serialisation as the cache in the database
+			metadata = json.loads(json.dumps(metadata))
+
+			entries.append((filename, metadata))
+
+		i._write(path, ARCH, entries, name)
+
+		self.assertEqual(self.read_repodata(expected), self.read_repodata(path))
+
+
+if __name__ == "__main__":
+	unittest.main()